@@ -0,0 +1,66 @@
+"""
+Benchmark of the association of comments to the leaves of the parse tree
+
+Generates comment-heavy contracts of growing size, where each function has
+trailing and standalone comments and a block of comments in between the
+arguments of a call, and reports the time spent attaching the comments
+to the leaves of the tokens they follow. That time should grow linearly with
+the number of lines.
+
+    python benchmarks/comment_association.py
+"""
+import time
+
+from mamushi.parsing.parser import Parser
+
+FUNCTIONS = 200
+COMMENT_BLOCKS = [10, 50, 100, 200, 400]
+
+
+def generate_contract(functions: int, block: int) -> str:
+    lines = []
+    for i in range(functions):
+        lines += [
+            "@external",
+            f"def f{i}(a: uint256) -> uint256:  # trailing {i}",
+            f"    # standalone {i}",
+            "    x: uint256 = self.g(",
+        ]
+        lines += [f"        # orphan {i} {j}" for j in range(block)]
+        lines += [
+            "        a,  # argument",
+            "        1,",
+            "    )",
+            "    return x",
+            "",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def time_association(parser: Parser, code: str) -> float:
+    grammar = parser._grammar
+    with grammar.lock:
+        parser._clear_comments()
+        module = parser.lalr.parse(parser.preprocess(code))
+        start = time.perf_counter()
+        parser._attach_comments(module)
+        return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = Parser()
+    print(f"{'lines':>8} {'comments':>9} {'time (ms)':>10} {'us/line':>8}")
+    for block in COMMENT_BLOCKS:
+        code = generate_contract(FUNCTIONS, block)
+        lines = code.count("\n") + 1
+        comments = code.count("#")
+        elapsed = min(time_association(parser, code) for _ in range(3))
+        print(
+            f"{lines:>8} {comments:>9} {elapsed * 1000:>10.1f}"
+            f" {elapsed / lines * 1e6:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark of the construction of pytrees
+
+Compares the parser, which builds the pytree as Lark reduces rules, with
+parsing to a Lark tree and converting it to a pytree afterwards, as the
+parser used to. Both are run on the test corpus file by file, and
+concatenated into a single module once and `SCALE` times.
+
+    python benchmarks/pytree_building.py
+"""
+import time
+from pathlib import Path
+from typing import Any, Callable, List, Tuple
+
+from lark import Lark, Tree
+
+from mamushi.parsing import registry
+from mamushi.parsing.parser import Parser
+from mamushi.parsing.pytree import Node
+
+DATA_DIR = Path(__file__).parent.parent / "tests" / "data"
+REPEAT = 5
+SCALE = 10
+
+
+def lark_tree_parser(parser: Parser) -> Lark:
+    """A parser of the same grammar that builds Lark trees"""
+    grammar = parser._grammar
+    return registry._compile(
+        registry.FORMATTING,
+        postlex=grammar.indenter,
+        lexer_callbacks={
+            "COMMENT": grammar.comments.append,
+            "_NEWLINE": lambda t: grammar.newlines.append(t) or t,
+        },
+    )
+
+
+def convert(parser: Parser, tree: Tree) -> Node:
+    """Convert a Lark tree to a pytree, children first"""
+    builder = parser._grammar.builder
+    stack: List[Tuple[Tree, List[Any]]] = [(tree, [])]
+    iterators = [iter(tree.children)]
+    while True:
+        current, children = stack[-1]
+        child = next(iterators[-1], None)
+        if isinstance(child, Tree):
+            stack.append((child, []))
+            iterators.append(iter(child.children))
+        elif child is not None:
+            children.append(child)
+        else:
+            node = builder(current.data, children)
+            stack.pop()
+            iterators.pop()
+            if not stack:
+                return node
+            stack[-1][1].append(node)
+
+
+def time_parse(
+    parser: Parser, code: str, parse: Callable[[str], Node]
+) -> float:
+    code = parser.preprocess(code)
+    best = float("inf")
+    with parser._grammar.lock:
+        for _ in range(REPEAT):
+            parser._clear_comments()
+            start = time.perf_counter()
+            parse(code)
+            best = min(best, time.perf_counter() - start)
+        parser._clear_comments()
+    return best
+
+
+def main() -> None:
+    parser = Parser()
+    lark = lark_tree_parser(parser)
+
+    def parse_and_convert(code: str) -> Node:
+        return convert(parser, lark.parse(code))
+
+    # the inputs of the test cases, which are followed by their output
+    sources = [
+        path.read_text(encoding="utf8").split("# output\n")[0]
+        for path in sorted(DATA_DIR.glob("*/*.vy*"))
+    ]
+    # both build the same tree
+    for code in sources:
+        with parser._grammar.lock:
+            parser._clear_comments()
+            expected = parser.lalr.parse(parser.preprocess(code))
+            parser._clear_comments()
+            assert parse_and_convert(parser.preprocess(code)) == expected
+    cases = {
+        f"{len(sources)} files": sources,
+        "concatenated": ["".join(sources)],
+        f"concatenated x{SCALE}": ["".join(sources) * SCALE],
+    }
+    print(f"{'corpus':>16} {'convert (ms)':>13} {'build (ms)':>11}")
+    for name, codes in cases.items():
+        converted = built = 0.0
+        for code in codes:
+            converted += time_parse(parser, code, parse_and_convert)
+            built += time_parse(parser, code, parser.lalr.parse)
+        print(f"{name:>16} {converted * 1000:>13.1f} {built * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of the per-file overhead of the worker processes
+
+Checks a few hundred small contracts with a pool of workers, like `main`
+does, and reports the time per file when:
+
+* each file builds its own grammar, which is what a fresh `Parser` per file
+  costs without the grammar registry;
+* each file creates its own `Parser`, sharing the grammar of its worker;
+* each worker builds a single `Parser` in its initializer, which is reused
+  for every file it formats and for comparing their ASTs.
+
+    python benchmarks/worker_parser.py
+"""
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+
+import mamushi
+from mamushi.parsing import registry
+
+FILES = 300
+PROCESSES = 2
+
+
+def generate_contract(i: int) -> str:
+    return (
+        "# @version 0.3.10\n"
+        f"total{i}: public(uint256)\n"
+        "\n"
+        "@external\n"
+        f"def add{i}(a: uint256, b: uint256) -> uint256:\n"
+        "    # add both\n"
+        f"    self.total{i} += a+b\n"
+        f"    return self.total{i}\n"
+    )
+
+
+def process_file_with_new_grammar(args: Tuple[Any, ...]) -> Any:
+    registry.reset()
+    return mamushi.process_file(args)
+
+
+def time_pool(
+    args_list: List[Tuple[Any, ...]],
+    process_file: Callable[[Tuple[Any, ...]], Any],
+    initializer: Optional[Callable[[], None]] = None,
+) -> float:
+    start = time.perf_counter()
+    with multiprocessing.Pool(PROCESSES, initializer=initializer) as pool:
+        results = pool.map(process_file, args_list)
+    elapsed = time.perf_counter() - start
+    assert all(result.success for result in results)
+    return elapsed
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        args_list = []
+        for i in range(FILES):
+            path = Path(directory) / f"contract_{i}.vy"
+            path.write_text(generate_contract(i), encoding="utf8")
+            args_list.append((path, 80, True, False, False, True, 0, None))
+        cases = {
+            "grammar per file": (process_file_with_new_grammar, None),
+            "parser per file": (mamushi.process_file, None),
+            "parser per worker": (mamushi.process_file, mamushi.init_worker),
+        }
+        print(f"{'':>18} {'total (ms)':>11} {'per file (ms)':>14}")
+        for name, (process_file, initializer) in cases.items():
+            elapsed = min(
+                time_pool(args_list, process_file, initializer)
+                for _ in range(3)
+            )
+            print(
+                f"{name:>18} {elapsed * 1000:>11.1f}"
+                f" {elapsed / FILES * 1000:>14.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,62 @@
 from dataclasses import dataclass
 
+from mamushi import lsp
 from mamushi.__version__ import __version__
 from datetime import datetime
 import io
+import re
 import sys
 from mamushi.formatting.format import format_tree
-from mamushi.parsing.comparator import compare_ast
+from mamushi.formatting.parallel import (
+    DEFAULT_PARALLEL_THRESHOLD,
+    format_in_parallel,
+)
+from mamushi.formatting.ranges import LineRange, format_line_ranges
+from mamushi.parsing.comparator import compare_ast, find_ast_change
 from mamushi.parsing.parser import Parser
-from mamushi.utils.files import gen_vyper_files_in_dir
+from mamushi.utils.backends import (
+    ANSWER_TIMEOUT,
+    REQUEST_TIMEOUT,
+    entry_key,
+    get_backend,
+)
+from mamushi.utils.cache import (
+    MAX_CACHE_ENTRIES,
+    Cache,
+    cache_stats,
+    clear_cache,
+    prune_cache,
+)
+from mamushi.utils.files import (
+    DEFAULT_EXCLUDES,
+    DISCOVERY_THREADS,
+    gen_vyper_files_in_dir,
+    write_atomically,
+)
+from mamushi.utils.git import GitError, changed_files
+from mamushi.utils.git import changed_lines as git_changed_lines
+from mamushi.utils.workers import available_cpus, choose_workers, schedule
 import traceback
-from typing import List
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    cast,
+)
 from pathlib import Path
 import click
 from mamushi.utils.output import out, diff, color_diff
 from mamushi.utils.report import Report, Changed
+import itertools
 import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, wait
 
 
 @dataclass
@@ -25,40 +67,50 @@ class ProcessResult:
     error_message: str | None = None
     traceback_str: str | None = None
     formatted_content: str | None = None
+    diff: str | None = None
+    # seconds spent processing the file
+    duration: float = 0.0
 
 
-def format_stdin_to_stdout(src: str, dst: str, file_path: Path | None):
-    """Format file on stdin. Return True if changed.
-
-    If content is None, it's read from sys.stdin.
-
-    If `write_back` is YES, write reformatted code back to stdout. If it is DIFF,
-    write a diff to stdout. The `mode` argument is passed to
-    :func:`format_file_contents`.
-    """
+def format_diff(src: str, dst: str, file_path: Path | None) -> str:
+    """Return the colored diff between the contents `src` and `dst` of the
+    file at `file_path`, as printed with `--diff`"""
     then = datetime.utcnow()
+    now = datetime.utcnow()
+    src_name = f"STDIN\t{then} +0000 - {file_path}"
+    dst_name = f"STDOUT\t{now} +0000 - {file_path}"
+    d = diff(src, dst, src_name, dst_name)
+    return color_diff(d)
 
-    encoding, newline = "utf-8", ""
 
+def write_to_stdout(content: str) -> None:
+    """Write `content` to stdout as is, without translating its newlines"""
     f = io.TextIOWrapper(
         sys.stdout.buffer,
-        encoding=encoding,
-        newline=newline,
+        encoding="utf-8",
+        newline="",
         write_through=True,
     )
-    now = datetime.utcnow()
-    src_name = f"STDIN\t{then} +0000 - {file_path}"
-    dst_name = f"STDOUT\t{now} +0000 - {file_path}"
-    d = diff(src, dst, src_name, dst_name)
-    d = color_diff(d)
-    f.write(d)
+    f.write(content)
     f.detach()
 
 
+# parser reused for every file formatted by a worker process
+_worker_parser: Parser | None = None
+
+
+def init_worker() -> None:
+    """Build the parser of a worker process once, before it gets any file"""
+    global _worker_parser
+    _worker_parser = Parser()
+
+
 def process_file(args):
-    src, line_length, safe, diff, in_place, check = args
-    parser = Parser()  # Create a new parser for each process
-    return reformat(
+    # `parallel` is the number of processes to split the file across, if any
+    src, line_length, safe, diff, in_place, check, parallel, line_ranges = args
+    parser = _worker_parser or Parser()
+    start = time.perf_counter()
+    result = reformat(
         src=src,
         parser=parser,
         safe=safe,
@@ -66,7 +118,16 @@ def process_file(args):
         in_place=in_place and not (check or diff),
         check=check,
         line_length=line_length,
+        parallel=parallel,
+        line_ranges=line_ranges,
     )
+    result.duration = time.perf_counter() - start
+    return result
+
+
+def process_task(task):
+    """Process the files of a task, see `schedule`"""
+    return [process_file(args) for args in task]
 
 
 def reformat(
@@ -77,11 +138,17 @@ def reformat(
     in_place: bool,
     check: bool,
     line_length: int,
+    parallel: int = 0,
+    line_ranges: Optional[List[LineRange]] = None,
 ):
     with open(src, "r") as fp:
         contract = fp.read()
     try:
-        src_content = parser.parse(contract)
+        if parallel:
+            # chunks of the file are parsed and formatted by separate workers
+            res = format_in_parallel(contract, line_length, parallel)
+        else:
+            src_content = parser.parse(contract, fingerprint=safe)
     except Exception:
         return ProcessResult(
             src=src,
@@ -90,33 +157,334 @@ def reformat(
             traceback_str=traceback.format_exc(),
         )
 
-    res = format_tree(src_content, line_length)
+    if line_ranges:
+        res = format_line_ranges(
+            src_content, contract, line_ranges, line_length
+        )
+    elif not parallel:
+        res = format_tree(src_content, line_length)
     changed = Changed.NO if res == contract else Changed.YES
 
-    if safe and not compare_ast(contract, res):
-        return ProcessResult(
-            src=src,
-            success=False,
-            error_message="Formatting changed the AST, aborting",
-        )
+    # an unchanged file can't have had its AST changed
+    if safe and changed is Changed.YES:
+        try:
+            change = find_ast_change(
+                contract,
+                res,
+                src_fingerprint=None if parallel else parser.last_fingerprint,
+                parser=parser,
+            )
+        except Exception:
+            return ProcessResult(
+                src=src,
+                success=False,
+                error_message="Formatting produced code that can't be parsed, aborting",
+                traceback_str=traceback.format_exc(),
+            )
+        if change is not None:
+            return ProcessResult(
+                src=src,
+                success=False,
+                error_message=f"Formatting changed the AST at {change}, aborting",
+            )
 
-    if check:
-        return ProcessResult(src=src, success=True, changed=changed)
+    # unchanged files aren't written, which would update their mtime
+    if in_place and changed is Changed.YES:
+        write_atomically(src, res)
 
-    if diff:
-        format_stdin_to_stdout(contract, res, src)
-        return ProcessResult(src=src, success=True, changed=changed)
+    # the diff is printed by the main process, in the order of the files
+    return ProcessResult(
+        src=src,
+        success=True,
+        changed=changed,
+        formatted_content=res,
+        diff=format_diff(contract, res, src) if diff and not check else None,
+    )
 
-    if in_place:
-        with open(src, "w") as fp:
-            fp.write(res)
 
+def reuse_output(
+    src: Path, output: bytes, in_place: bool, safe: bool = False
+) -> Optional[ProcessResult]:
+    """
+    Apply the formatted `output` of `src` found in a cache backend. With
+    `safe`, None is returned instead if `output` isn't valid Vyper code
+    with the same AST as `src`, as the backend may not be trusted.
+    """
+    with open(src, "rb") as fp:
+        contract = fp.read()
+    if output == contract:
+        return ProcessResult(src=src, success=True, changed=Changed.CACHED)
+    if safe:
+        try:
+            change = find_ast_change(
+                contract.decode("utf8"), output.decode("utf8"), parser=Parser()
+            )
+        except Exception:
+            return None
+        if change is not None:
+            return None
+    if in_place:
+        write_atomically(src, output)
     return ProcessResult(
-        src=src, success=True, changed=changed, formatted_content=res
+        src=src,
+        success=True,
+        changed=Changed.YES,
+        formatted_content=output.decode("utf8"),
+    )
+
+
+def feed(
+    tasks: List[List[Tuple[Any, ...]]],
+    lookups: Dict[Path, "Future[Optional[bytes]]"],
+    found: List[Tuple[Tuple[Any, ...], bytes]],
+    slots: Optional[threading.Semaphore] = None,
+) -> Iterator[List[Tuple[Any, ...]]]:
+    """
+    Hand the `tasks` over to the workers, at most one per free slot,
+    skipping the files whose output was found in a cache backend by then,
+    whose arguments are added to `found` with it. Lookups are never waited
+    for.
+    """
+    for task in tasks:
+        if slots is not None:
+            slots.acquire()
+        remaining = []
+        for args in task:
+            lookup = lookups.get(args[0])
+            output = lookup.result() if lookup and lookup.done() else None
+            if output is not None:
+                found.append((args, output))
+            else:
+                remaining.append(args)
+        if not remaining:
+            if slots is not None:
+                slots.release()
+            continue
+        yield remaining
+
+
+def run_in_pool(
+    tasks: List[List[Tuple[Any, ...]]],
+    workers: int,
+    lookups: Dict[Path, "Future[Optional[bytes]]"],
+    found: List[Tuple[Tuple[Any, ...], bytes]],
+) -> Iterator[ProcessResult]:
+    """
+    Process the `tasks` with a pool of `workers` processes, yielding the
+    results of their files in the order they complete
+    """
+    with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+        # with a backend, tasks are only handed over as workers free up,
+        # which gives their lookups the most time to complete
+        slots = threading.Semaphore(2 * workers) if lookups else None
+        try:
+            for results in pool.imap_unordered(
+                process_task, feed(tasks, lookups, found, slots)
+            ):
+                if slots is not None:
+                    slots.release()
+                yield from results
+        except BaseException:
+            # don't leave the feeder waiting for a slot
+            if slots is not None:
+                slots.release(len(tasks))
+            raise
+
+
+def process_files(
+    args_list: List[Tuple[Any, ...]],
+    sizes: List[int],
+    large_args_list: List[Tuple[Any, ...]],
+    workers: int,
+    lookups: Dict[Path, "Future[Optional[bytes]]"],
+    write_back: bool,
+) -> Iterator[ProcessResult]:
+    """
+    Yield the results of the files of `args_list`, of the given `sizes`,
+    processed by `workers` processes (or in-process if 0), then of the
+    large files of `large_args_list`, in the order they complete. The files
+    whose output was found in a cache backend are yielded as soon as they
+    are skipped.
+    """
+    found: List[Tuple[Tuple[Any, ...], bytes]] = []
+    if workers:
+        tasks = [[args_list[i] for i in task] for task in schedule(sizes)]
+        results = run_in_pool(tasks, workers, lookups, found)
+    else:
+        results = (
+            process_file(args)
+            for task in feed([[args] for args in args_list], lookups, found)
+            for args in task
+        )
+    # large files are split across processes, one file at a time, as the
+    # workers of a pool can't start workers of their own
+    large_results = (
+        process_file(args)
+        for task in feed([[args] for args in large_args_list], lookups, found)
+        for args in task
     )
+    for result in itertools.chain(results, large_results, [None]):
+        while found:
+            args, output = found.pop(0)
+            # outputs that don't pass the AST check are formatted locally
+            yield reuse_output(
+                args[0], output, write_back, safe=args[2]
+            ) or process_file(args)
+        if result is not None:
+            yield result
+
+
+def in_order(
+    results: Iterable[ProcessResult], sources: List[Path]
+) -> Iterator[ProcessResult]:
+    """
+    Yield `results` in the order of their `sources`, each as soon as the
+    results of the files before it have been
+    """
+    order = {source: i for i, source in enumerate(sources)}
+    pending: Dict[int, ProcessResult] = {}
+    next_index = 0
+    for result in results:
+        pending[order[result.src]] = result
+        while next_index in pending:
+            yield pending.pop(next_index)
+            next_index += 1
+
+
+def validate_line_ranges(values: Tuple[str, ...]) -> List[LineRange]:
+    """Convert `START-END` ranges of lines, counted from 1 and inclusive,
+    to line ranges"""
+    line_ranges = []
+    for value in values:
+        try:
+            start, end = map(int, value.split("-"))
+        except ValueError:
+            raise click.BadParameter(f"{value!r} is not of the form START-END")
+        if not 0 < start <= end:
+            raise click.BadParameter(
+                f"{value!r} doesn't start from 1 or ends before it starts"
+            )
+        line_ranges.append((start - 1, end))
+    return line_ranges
+
+
+def validate_regex(value: Optional[str]) -> Optional[Pattern[str]]:
+    if value is None:
+        return None
+    try:
+        return re.compile(value)
+    except re.error as e:
+        raise click.BadParameter(f"{value!r} is not a valid regex: {e}")
+
+
+def get_sources(
+    src: List[str],
+    exclude: Optional[Pattern[str]] = None,
+    extend_exclude: Optional[Pattern[str]] = None,
+) -> List[Path]:
+    """
+    Return the files to format: those given, and the Vyper files found in
+    the directories given, the current one by default, that aren't
+    excluded. The .gitignore files are honoured unless `exclude` is given.
+    A file given several times, or also found in a directory given, is only
+    returned once.
+    """
+    sources: List[Path] = []
+    if not src:
+        src = [str(Path.cwd().resolve())]
+    threads = min(available_cpus(), DISCOVERY_THREADS)
 
+    for s in src:
+        p = Path(s)
+        if p.is_dir():
+            sources.extend(
+                gen_vyper_files_in_dir(
+                    p,
+                    exclude=exclude,
+                    extend_exclude=extend_exclude,
+                    gitignore=exclude is None,
+                    threads=threads,
+                )
+            )
+        elif p.is_file():
+            # if a file was explicitly given, we don't care about its extension
+            sources.append(p)
+        else:
+            raise FileNotFoundError(f"invalid path: {s}")
+    return list(dict.fromkeys(sources))
+
+
+def select_changed(
+    sources: List[Path], rev: str, lines: bool
+) -> Tuple[List[Path], Dict[Path, Optional[List[LineRange]]]]:
+    """
+    Return the `sources` changed since the git revision `rev`, along with
+    the lines of each to format: those added or modified if `lines`, or
+    all of them (None)
+    """
+    changed = changed_files(rev)
+    sources = [source for source in sources if source.resolve() in changed]
+    if not lines:
+        return sources, {source: None for source in sources}
+    ranges = git_changed_lines(rev, [source.resolve() for source in sources])
+    sources = [source for source in sources if source.resolve() in ranges]
+    return sources, {source: ranges[source.resolve()] for source in sources}
 
-@click.command()
+
+class MainCommand(click.Command):
+    """
+    The formatting command, which hands over to one of its `subcommands`
+    when its first argument is the name of one. A path with the name of a
+    subcommand is formatted when given as `./<name>`, or after `--`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.subcommands: Dict[str, click.Command] = {}
+
+    def add_subcommand(self, command: click.Command) -> click.Command:
+        assert command.name is not None
+        self.subcommands[command.name] = command
+        return command
+
+    def parse_args(self, ctx: click.Context, args: List[str]) -> List[str]:
+        if args and args[0] in self.subcommands:
+            # the remaining arguments are the subcommand's own
+            ctx.invoked_subcommand = args[0]
+            ctx.args = args[1:]
+            return []
+        return super().parse_args(ctx, args)
+
+    def invoke(self, ctx: click.Context) -> Any:
+        name = ctx.invoked_subcommand
+        if name is None:
+            return super().invoke(ctx)
+        if Path(name).exists():
+            out(
+                f"Running the {name} command, use ./{name} to format the"
+                f" path {name}",
+                fg="yellow",
+            )
+        command = self.subcommands[name]
+        # not a child context, whose usage would include the paths to format
+        info_name = f"{ctx.info_name} {name}"
+        with command.make_context(info_name, ctx.args) as sub_ctx:
+            return command.invoke(sub_ctx)
+
+    def format_epilog(
+        self, ctx: click.Context, formatter: click.HelpFormatter
+    ) -> None:
+        with formatter.section("Commands"):
+            formatter.write_dl(
+                [
+                    (name, command.get_short_help_str(formatter.width))
+                    for name, command in sorted(self.subcommands.items())
+                ]
+            )
+        super().format_epilog(ctx, formatter)
+
+
+@click.command(cls=MainCommand)
 @click.version_option(__version__)
 @click.option(
     "-l",
@@ -140,6 +508,80 @@ def reformat(
     show_default=True,
     help="Compares input and output AST to ensure similarity",
 )
+@click.option(
+    "--parallel-threshold",
+    type=int,
+    default=DEFAULT_PARALLEL_THRESHOLD,
+    show_default=True,
+    help=(
+        "Size in bytes from which a file is split at top-level definitions,"
+        " and its chunks formatted in parallel. 0 disables splitting files."
+    ),
+)
+@click.option(
+    "--line-ranges",
+    multiple=True,
+    metavar="START-END",
+    callback=lambda ctx, param, value: validate_line_ranges(value),
+    help=(
+        "Only format the given range of lines, counted from 1 and inclusive."
+        " Can be given several times, with a single file."
+    ),
+)
+@click.option(
+    "--exclude",
+    callback=lambda ctx, param, value: validate_regex(value),
+    help=(
+        "Regex matching the files and directories to exclude when looking for"
+        " Vyper files, against their path relative to the directory given,"
+        " starting with a slash and ending with one for directories. Replaces"
+        " the defaults and the .gitignore files. [default:"
+        f" {DEFAULT_EXCLUDES}]"
+    ),
+)
+@click.option(
+    "--extend-exclude",
+    callback=lambda ctx, param, value: validate_regex(value),
+    help=(
+        "Like --exclude, but excludes files and directories in addition to"
+        " those excluded by default or by --exclude."
+    ),
+)
+@click.option(
+    "--changed-since",
+    metavar="REV",
+    help=(
+        "Only format the files changed since the git revision REV, whether"
+        " the changes are staged or not, and the untracked files."
+    ),
+)
+@click.option(
+    "--changed-lines",
+    is_flag=True,
+    help=(
+        "With --changed-since, only format the lines added or modified since"
+        " REV."
+    ),
+)
+@click.option(
+    "--cache-backend",
+    envvar="MAMUSHI_CACHE_BACKEND",
+    help=(
+        "Directory or HTTP(S) URL of a store of formatted outputs, shared by"
+        " the runs of every machine using it."
+    ),
+)
+@click.option(
+    "-W",
+    "--workers",
+    "requested_workers",
+    type=click.IntRange(min=0),
+    help=(
+        "Number of worker processes, 0 to format files in-process. By default,"
+        " small batches are formatted in-process and larger ones by up to one"
+        " worker per available CPU."
+    ),
+)
 @click.option(
     "--check",
     is_flag=True,
@@ -187,41 +629,156 @@ def main(
     verbose: bool,
     quiet: bool,
     safe: bool,
+    parallel_threshold: int,
+    cache_backend: Optional[str],
+    requested_workers: Optional[int],
+    line_ranges: List[LineRange],
+    exclude: Optional[Pattern[str]],
+    extend_exclude: Optional[Pattern[str]],
+    changed_since: Optional[str],
+    changed_lines: bool,
     src: List[str],
 ) -> None:
-    sources: List[Path] = []
-    if not src:
-        src = [str(Path.cwd().resolve())]
+    sources = get_sources(src, exclude, extend_exclude)
+    if line_ranges and len(sources) != 1:
+        ctx.fail("--line-ranges can only be used to format a single file.")
+    if changed_lines and changed_since is None:
+        ctx.fail("--changed-lines can only be used with --changed-since.")
+    if line_ranges and changed_since is not None:
+        ctx.fail("--line-ranges can't be used with --changed-since.")
 
-    for s in src:
-        p = Path(s)
-        if p.is_dir():
-            sources.extend(gen_vyper_files_in_dir(p))
-        elif p.is_file():
-            # if a file was explicitly given, we don't care about its extension
-            sources.append(p)
-        else:
-            raise FileNotFoundError(f"invalid path: {s}")
+    # lines of each file to format, None meaning all of them
+    source_ranges = {source: line_ranges or None for source in sources}
+    if changed_since is not None:
+        try:
+            sources, source_ranges = select_changed(
+                sources, changed_since, changed_lines
+            )
+        except GitError as e:
+            ctx.fail(f"--changed-since: {e}")
+
+    # files known formatted are skipped, unless their output is needed
+    print_output = not (in_place or check or diff)
+    # and formatting ranges of lines doesn't leave files formatted
+    use_cache = not (print_output or diff or line_ranges or changed_lines)
+    cached: List[Path] = []
+    if use_cache:
+        cache = Cache.read(line_length, safe, sources)
+        sources, cached = cache.filtered_cached(sources)
 
+    # outputs of the other files are looked up in the background
+    backend = (
+        get_backend(cache_backend) if use_cache and cache_backend else None
+    )
+    keys: Dict[Path, str] = {}
+    lookups: Dict[Path, Future[Optional[bytes]]] = {}
+    if backend is not None:
+        for source in sources:
+            with open(source, "rb") as fp:
+                keys[source] = entry_key(fp.read(), line_length, safe)
+        futures = backend.lookup_many(set(keys.values()))
+        lookups = {source: futures[key] for source, key in keys.items()}
+
+    sizes = {source: source.stat().st_size for source in sources}
+    large = {
+        source
+        for source in sources
+        if parallel_threshold > 0
+        and sizes[source] >= parallel_threshold
+        and source_ranges.get(source) is None
+    }
     args_list = [
-        (source, line_length, safe, diff, in_place, check)
+        (
+            source,
+            line_length,
+            safe,
+            diff,
+            in_place,
+            check,
+            0,
+            source_ranges.get(source),
+        )
+        for source in sources
+        if source not in large
+    ]
+    workers = choose_workers(
+        [sizes[args[0]] for args in args_list], requested_workers
+    )
+
+    # large files are split across all the CPUs, or the requested number of
+    # workers
+    processes = (
+        available_cpus() if requested_workers is None else requested_workers
+    )
+    large_args_list = [
+        (source, line_length, safe, diff, in_place, check, processes, None)
         for source in sources
+        if source in large
     ]
+    start = time.perf_counter()
+    results = process_files(
+        args_list,
+        [sizes[args[0]] for args in args_list],
+        large_args_list,
+        workers,
+        lookups,
+        write_back=in_place and not check,
+    )
+    if print_output or diff:
+        # what is printed doesn't depend on the order files complete in
+        results = in_order(results, sources)
 
-    # Use multiprocessing to process files
-    with multiprocessing.Pool() as pool:
-        results = pool.map(process_file, args_list)
     report = Report(check=check, diff=diff, quiet=quiet, verbose=verbose)
+    for source in cached:
+        report.done(source, Changed.CACHED)
 
+    # results are reported as they come, and dropped right after
+    stored: List[Future] = []
+    done: List[Path] = []
+    durations = 0.0
     for result in results:
+        durations += result.duration
         if not result.success:
             if verbose and result.traceback_str:
                 out(result.traceback_str)
-            report.failed(result.src, result.error_message)
-        else:
-            report.done(result.src, result.changed)
-            if not in_place and result.formatted_content:
-                click.echo(result.formatted_content)
+            report.failed(result.src, cast(str, result.error_message))
+            continue
+        report.done(result.src, cast(Changed, result.changed))
+        if result.diff:
+            write_to_stdout(result.diff)
+        if print_output and result.formatted_content:
+            click.echo(result.formatted_content)
+        if result.changed is Changed.NO or (
+            in_place and not check and not diff
+        ):
+            done.append(result.src)
+        if backend is not None and result.formatted_content is not None:
+            # share the output, under the key of its source and of the
+            # output itself, which is formatted
+            output = result.formatted_content.encode("utf8")
+            stored.append(backend.store(keys[result.src], output))
+            stored.append(
+                backend.store(entry_key(output, line_length, safe), output)
+            )
+
+    if verbose and sources:
+        # the time the run took, against the time its files took
+        makespan = time.perf_counter() - start
+        by = f"{workers} workers" if workers else "in-process"
+        out(
+            f"Processed {len(sources)} files in {makespan:.2f}s ({by}),"
+            f" {durations:.2f}s for the files one after another",
+            bold=False,
+        )
+
+    if backend is not None:
+        # a backend that didn't answer every lookup is not waited for
+        if not wait(lookups.values(), timeout=ANSWER_TIMEOUT).not_done:
+            wait(stored, timeout=REQUEST_TIMEOUT)
+        backend.close()
+    if use_cache:
+        # files skipped by their hash have their stat data updated
+        cache.write(cached + done)
 
     error_msg = "Oh no! 💥 💔 💥"
     if verbose or not quiet:
@@ -231,5 +788,71 @@ def main(
     ctx.exit(report.return_code)
 
 
+@click.command(name="lsp")
+@click.option(
+    "-l",
+    "--line-length",
+    type=int,
+    default=80,
+    help="Max line length, unless set by the client",
+    show_default=True,
+)
+@click.option(
+    "--safe",
+    type=bool,
+    default=True,
+    show_default=True,
+    help="Compares input and output AST to ensure similarity",
+)
+@click.pass_context
+def lsp_command(ctx: click.Context, line_length: int, safe: bool) -> None:
+    """Run a language server over stdio, to format documents in editors."""
+    ctx.exit(lsp.serve(line_length, safe))
+
+
+@click.group(name="cache")
+def cache_command() -> None:
+    """Inspect and manage the cache of formatted files."""
+
+
+@cache_command.command()
+def stats() -> None:
+    """Show the size of the cache, and its entries for each set of options."""
+    stats = cache_stats()
+    click.echo(f"location: {stats.path}")
+    click.echo(f"size: {stats.size} bytes")
+    for options in sorted(set(stats.digests) | set(stats.files)):
+        line_length, safe = options.split(".")
+        click.echo(
+            f"line length {line_length}, safe {safe == '1'}:"
+            f" {stats.digests.get(options, 0)} contents,"
+            f" {stats.files.get(options, 0)} files"
+        )
+
+
+@cache_command.command()
+def clear() -> None:
+    """Delete the cache."""
+    clear_cache()
+    click.echo("Cache cleared.")
+
+
+@cache_command.command()
+@click.option(
+    "--max-entries",
+    type=int,
+    default=MAX_CACHE_ENTRIES,
+    show_default=True,
+    help="Most contents and files to keep, the least recently used first out.",
+)
+def prune(max_entries: int) -> None:
+    """Drop entries of deleted files and least recently used entries."""
+    click.echo(f"Pruned {prune_cache(max_entries)} entries.")
+
+
+cast(MainCommand, main).add_subcommand(cache_command)
+cast(MainCommand, main).add_subcommand(lsp_command)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,333 @@
+"""
+Formatting daemon, the mamushi counterpart of blackd
+
+`mamushid` formats the sources it receives over HTTP, on a local port or a
+Unix socket, with worker processes that build their parser once and keep it
+for every request. Clients such as editor plugins and pre-commit hooks are
+spared the start of an interpreter and the loading of the grammar each time
+they format a file.
+
+A request is a `POST` with the source as its body, and optional headers:
+
+* `X-Line-Length`: the maximum line length, 80 by default;
+* `X-Safe`: whether to compare the ASTs of the source and of the output,
+  `true` (the default) or `false`;
+* `X-Check`: only tell whether the source would be reformatted;
+* `X-Diff`: return a diff of the changes instead of the output.
+
+It is answered with 204 if the source is already formatted, otherwise with
+200 and the output (empty with `X-Check`, or the diff with `X-Diff`), with
+400 if the source can't be formatted, 503 if the daemon is busy with as many
+requests as it accepts at once, and 504 if its body wasn't received or
+formatting it took too long. Connections whose headers aren't received in
+time are closed without an answer.
+"""
+import socket
+import socketserver
+import stat
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool, TimeoutError
+from pathlib import Path
+from typing import Optional, Tuple
+
+import click
+
+import mamushi
+from mamushi.__version__ import __version__
+from mamushi.formatting.format import format_tree
+from mamushi.parsing.comparator import find_ast_change
+from mamushi.parsing.parser import Parser
+from mamushi.utils.backends import entry_key
+from mamushi.utils.output import diff
+from mamushi.utils.workers import available_cpus
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 45485
+
+# seconds a request may take to be read and formatted
+DEFAULT_TIMEOUT = 10.0
+
+# formatted outputs kept in memory, for sources sent over and over again
+OUTPUT_CACHE_SIZE = 256
+
+
+class InvalidHeader(ValueError):
+    """Raised when a request header has an invalid value."""
+
+
+def format_source(args: Tuple[str, int, bool]) -> Tuple[str, Optional[str]]:
+    """
+    Format a source in a worker process. Returns the output and None, or
+    the source and why it can't be formatted, as parse errors don't always
+    survive pickling.
+    """
+    source, line_length, safe = args
+    parser = mamushi._worker_parser or Parser()
+    try:
+        output = format_tree(
+            parser.parse(source, fingerprint=safe), line_length
+        )
+    except Exception:
+        return source, "Unable to parse the source"
+    if safe and output != source:
+        try:
+            change = find_ast_change(
+                source,
+                output,
+                src_fingerprint=parser.last_fingerprint,
+                parser=parser,
+            )
+        except Exception:
+            return source, "Formatting produced code that can't be parsed"
+        if change is not None:
+            return source, f"Formatting changed the AST at {change}"
+    return output, None
+
+
+def parse_flag(value: Optional[str], default: bool) -> bool:
+    if value is None:
+        return default
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    raise InvalidHeader(f"invalid boolean value: {value!r}")
+
+
+class Formatter:
+    """
+    Formats sources in a pool of `workers` processes, accepting at most
+    `max_requests` at once, which includes those still being formatted
+    after timing out, as a worker can't be interrupted
+    """
+
+    def __init__(self, workers: int, max_requests: int, timeout: float):
+        self.pool = Pool(workers, initializer=mamushi.init_worker)
+        self.slots = threading.BoundedSemaphore(max_requests)
+        self.timeout = timeout
+        self.outputs: "OrderedDict[str, Tuple[str, Optional[str]]]" = (
+            OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    def format(
+        self, source: str, line_length: int, safe: bool
+    ) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Return the result of `format_source`, or None if the daemon is too
+        busy. Raises `TimeoutError` if formatting takes too long.
+        """
+        key = entry_key(source.encode("utf8"), line_length, safe)
+        with self.lock:
+            if key in self.outputs:
+                self.outputs.move_to_end(key)
+                return self.outputs[key]
+        if not self.slots.acquire(blocking=False):
+            return None
+        try:
+            pending = self.pool.apply_async(
+                format_source,
+                ((source, line_length, safe),),
+                callback=lambda _: self.slots.release(),
+                error_callback=lambda _: self.slots.release(),
+            )
+        except BaseException:
+            self.slots.release()
+            raise
+        result = pending.get(self.timeout)
+        with self.lock:
+            self.outputs[key] = result
+            if len(self.outputs) > OUTPUT_CACHE_SIZE:
+                self.outputs.popitem(last=False)
+        return result
+
+    def close(self) -> None:
+        self.pool.terminate()
+        self.pool.join()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = f"mamushid/{__version__}"
+    protocol_version = "HTTP/1.1"
+    formatter: Formatter
+
+    def do_POST(self) -> None:
+        try:
+            line_length = int(self.headers.get("X-Line-Length", 80))
+            safe = parse_flag(self.headers.get("X-Safe"), True)
+            check = parse_flag(self.headers.get("X-Check"), False)
+            show_diff = parse_flag(self.headers.get("X-Diff"), False)
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError(f"Invalid Content-Length: {length}")
+            source = self.rfile.read(length).decode("utf8")
+        except (InvalidHeader, ValueError) as e:
+            self.reply(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        except socket.timeout:
+            # the rest of the body may still come, so the connection can't
+            # be used for another request
+            self.close_connection = True
+            self.reply(
+                HTTPStatus.GATEWAY_TIMEOUT, "Reading the body timed out"
+            )
+            return
+
+        then = datetime.now(timezone.utc)
+        try:
+            result = self.formatter.format(source, line_length, safe)
+        except TimeoutError:
+            self.reply(HTTPStatus.GATEWAY_TIMEOUT, "Formatting timed out")
+            return
+        if result is None:
+            self.reply(HTTPStatus.SERVICE_UNAVAILABLE, "Too many requests")
+            return
+        output, error = result
+        if error is not None:
+            self.reply(HTTPStatus.BAD_REQUEST, error)
+        elif output == source:
+            self.reply(HTTPStatus.NO_CONTENT)
+        elif check:
+            self.reply(HTTPStatus.OK)
+        elif show_diff:
+            now = datetime.now(timezone.utc)
+            self.reply(
+                HTTPStatus.OK,
+                diff(source, output, f"In\t{then}", f"Out\t{now}"),
+            )
+        else:
+            self.reply(HTTPStatus.OK, output)
+
+    def reply(self, status: HTTPStatus, body: str = "") -> None:
+        data = body.encode("utf8")
+        self.send_response(status)
+        if status is not HTTPStatus.NO_CONTENT:
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+        if status is HTTPStatus.SERVICE_UNAVAILABLE:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # clients of a Unix socket have no address
+        return str(self.client_address[0]) if self.client_address else "-"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class ThreadingUnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+
+def make_server(
+    formatter: Formatter,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    socket_path: Optional[Path] = None,
+) -> socketserver.BaseServer:
+    """Return a server answering requests with `formatter`, on `host` and
+    `port`, or on the Unix socket at `socket_path` if given, raising
+    FileExistsError if something other than a socket is there"""
+    # reading a request is subject to the timeout as well
+    handler = type(
+        "BoundRequestHandler",
+        (RequestHandler,),
+        {"formatter": formatter, "timeout": formatter.timeout},
+    )
+    if socket_path is not None:
+        # a socket left by a previous run is replaced, anything else is kept
+        try:
+            mode = socket_path.lstat().st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(
+                    f"{socket_path} exists and isn't a socket"
+                )
+            socket_path.unlink()
+        return ThreadingUnixHTTPServer(str(socket_path), handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.version_option(__version__)
+@click.option(
+    "--bind-host",
+    default=DEFAULT_HOST,
+    show_default=True,
+    help="Address to bind the server to.",
+)
+@click.option(
+    "--bind-port",
+    type=int,
+    default=DEFAULT_PORT,
+    show_default=True,
+    help="Port to listen on.",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Unix socket to listen on, instead of a port.",
+)
+@click.option(
+    "-W",
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Number of worker processes.  [default: number of available CPUs]",
+)
+@click.option(
+    "--max-requests",
+    type=click.IntRange(min=1),
+    help=(
+        "Number of requests accepted at once, beyond which requests are"
+        " answered with 503.  [default: 4 per worker]"
+    ),
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    default=DEFAULT_TIMEOUT,
+    show_default=True,
+    help="Seconds a request may take, beyond which it is answered with 504.",
+)
+def main(
+    bind_host: str,
+    bind_port: int,
+    socket_path: Optional[Path],
+    workers: Optional[int],
+    max_requests: Optional[int],
+    timeout: float,
+) -> None:
+    """Format Vyper code sent over HTTP."""
+    workers = workers or available_cpus()
+    formatter = Formatter(workers, max_requests or 4 * workers, timeout)
+    try:
+        server = make_server(formatter, bind_host, bind_port, socket_path)
+    except FileExistsError as e:
+        formatter.close()
+        raise click.BadParameter(str(e), param_hint="--socket")
+    where = socket_path or f"http://{bind_host}:{bind_port}"
+    click.echo(f"mamushid listening on {where}", err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        formatter.close()
+        if socket_path is not None:
+            socket_path.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
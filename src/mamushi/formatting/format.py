@@ -1,8 +1,22 @@
 from mamushi.formatting.linegen import LineGenerator, EmptyLineTracker
-from mamushi.formatting.lines import Line, split_line
+from mamushi.formatting.lines import Line, is_line_final, split_line
 from mamushi.parsing.pytree import Node
 
 
+def render_line(current_line: Line, max_line_length: int = 80) -> str:
+    """Split `current_line` if needed and return the resulting source"""
+    rendered = str(current_line)
+    # most lines of formatted files are emitted as they are
+    if "# nosplit" in rendered or is_line_final(
+        current_line, max_line_length, line_str=rendered.strip("\n")
+    ):
+        return rendered
+    return "".join(
+        str(line)
+        for line in split_line(current_line, line_length=max_line_length)
+    )
+
+
 def format_tree(ast: Node, max_line_length: int = 80) -> str:
     lg = LineGenerator(max_line_length)
     elt = EmptyLineTracker()
@@ -14,10 +28,6 @@ def format_tree(ast: Node, max_line_length: int = 80) -> str:
         dst_contents.append(str(empty_line) * after)
         before, after = elt.maybe_empty_lines(current_line)
         dst_contents.append(str(empty_line) * before)
-        if "# nosplit" in str(current_line):
-            dst_contents.append(str(current_line))
-        else:
-            for line in split_line(current_line, line_length=max_line_length):
-                dst_contents.append(str(line))
+        dst_contents.append(render_line(current_line, max_line_length))
 
     return "".join(dst_contents)
@@ -0,0 +1,242 @@
+"""
+Incremental formatting of successive versions of the same module
+
+The module is split into top-level units: a statement starting at the first
+column, along with its decorators, body and the comments and empty lines
+that follow it. Each unit is parsed and formatted on its own, and the result
+is cached by the hash of its source, so that formatting a new version of the
+module only re-parses and re-formats the units that changed.
+
+Units are formatted exactly like they would be as part of the whole module:
+
+* every unit but the last is parsed followed by a sentinel statement, which
+  stands for the next unit. The tokens at the end of the unit are therefore
+  the same as in the whole module, and the sentinel receives the empty lines
+  the next unit would;
+* the empty lines between all the lines of the module are computed by
+  running `EmptyLineTracker` over snapshots of the lines, taken at the time
+  the tracker would have looked at them during a full run.
+"""
+import hashlib
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from lark.exceptions import LarkError
+
+from mamushi.formatting.format import format_tree, render_line
+from mamushi.formatting.linegen import EmptyLineTracker, LineGenerator
+from mamushi.formatting.lines import Line
+from mamushi.parsing.parser import Parser
+from mamushi.parsing.pytree import Leaf
+
+SENTINEL = "__mamushi_next_unit__"
+SENTINEL_STATEMENT = f"{SENTINEL}: uint256\n"
+
+_SCANNER = re.compile(
+    r"""
+    (?P<string>\"\"\"[\s\S]*?\"\"\"|'''[\s\S]*?'''
+        |"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+    |(?P<comment>\#[^\n]*)
+    |(?P<open>[(\[{])
+    |(?P<close>[)\]}])
+    |(?P<continuation>\\\r?\n)
+    |(?P<newline>\n)
+    """,
+    re.VERBOSE,
+)
+
+
+def split_units(source: str) -> List[str]:
+    """
+    Split `source` into top-level units. A unit starts on each line that
+    starts a statement in the first column, unless it follows a decorator.
+    Comments and empty lines belong to the unit above them, and everything
+    up to the first statement belongs to the first unit.
+    """
+    starts = [0]
+    depth = 0
+    seen_statement = bool(source) and source[0] not in " \t\r\n#"
+    after_decorator = source.startswith("@")
+    for match in _SCANNER.finditer(source):
+        kind = match.lastgroup
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth = max(depth - 1, 0)
+        elif kind == "newline" and depth == 0:
+            start = match.end()
+            if start == len(source) or source[start] in " \t\r\n#":
+                continue
+            if seen_statement and not after_decorator:
+                starts.append(start)
+            seen_statement = True
+            after_decorator = source[start] == "@"
+    starts.append(len(source))
+    return [source[i:j] for i, j in zip(starts, starts[1:])]
+
+
+@dataclass
+class FrozenLine(Line):
+    """
+    Snapshot of what `EmptyLineTracker` looks at in a line. Splitting a line
+    can change how it is classified, as its original leaves get detached
+    from the tree, so lines are frozen at the time the tracker would have
+    looked at them during a full run.
+    """
+
+    prefix: str = ""
+    decorator: bool = False
+    definition: bool = False
+    flow_control: bool = False
+    pragma: bool = False
+    import_: bool = False
+    comment: bool = False
+
+    @classmethod
+    def freeze(cls, line: Line) -> "FrozenLine":
+        return cls(
+            depth=line.depth,
+            prefix=line.leaves[0].prefix if line.leaves else "",
+            decorator=line.is_decorator,
+            definition=line.is_def,
+            flow_control=line.is_flow_control,
+            pragma=line.is_pragma,
+            import_=line.is_import,
+            comment=line.is_comment,
+            leaves=[Leaf(line.leaves[0].type, "")] if line.leaves else [],
+        )
+
+    def restore_prefix(self, extra: str = "") -> None:
+        """Restore the prefix the tracker consumes, preceded by `extra`"""
+        if self.leaves:
+            self.leaves[0].prefix = extra + self.prefix
+
+    @property
+    def is_decorator(self) -> bool:
+        return self.decorator
+
+    @property
+    def is_def(self) -> bool:
+        return self.definition
+
+    @property
+    def is_flow_control(self) -> bool:
+        return self.flow_control
+
+    @property
+    def is_pragma(self) -> bool:
+        return self.pragma
+
+    @property
+    def is_import(self) -> bool:
+        return self.import_
+
+    @property
+    def is_comment(self) -> bool:
+        return self.comment
+
+
+@dataclass
+class FormattedLine:
+    # the line as the tracker sees it before and after it is split
+    current: FrozenLine
+    previous: FrozenLine
+    source: str
+
+
+@dataclass
+class FormattedUnit:
+    lines: List[FormattedLine] = field(default_factory=list)
+    # prefix handed over to the first leaf of the next unit
+    carry: str = ""
+
+
+def format_unit(
+    parser: Parser, text: str, last: bool, max_line_length: int = 80
+) -> FormattedUnit:
+    """
+    Format the top-level unit `text`, as if it was followed by another unit
+    unless it is the `last` one of its module
+    """
+    tree = parser.parse(text if last else text + SENTINEL_STATEMENT)
+    unit = FormattedUnit()
+    for line in LineGenerator(max_line_length).visit(tree):
+        if not last and line.leaves and line.leaves[0].value == SENTINEL:
+            unit.carry = line.leaves[0].prefix
+            break
+        current = FrozenLine.freeze(line)
+        if line.leaves:
+            # consumed by the tracker before the line is split
+            line.leaves[0].prefix = ""
+        source = render_line(line, max_line_length)
+        unit.lines.append(
+            FormattedLine(current, FrozenLine.freeze(line), source)
+        )
+    return unit
+
+
+def stitch_units(units: List[FormattedUnit]) -> str:
+    """Join formatted units, with the empty lines of a full run between them"""
+    elt = EmptyLineTracker()
+    empty_line = str(Line())
+    after = 0
+    carry = ""
+    dst_contents = []
+    for unit in units:
+        for line in unit.lines:
+            dst_contents.append(empty_line * after)
+            line.current.restore_prefix(carry)
+            carry = ""
+            before, after = elt.maybe_empty_lines(line.current)
+            elt.previous_line = line.previous
+            dst_contents.append(empty_line * before)
+            dst_contents.append(line.source)
+        carry += unit.carry
+    return "".join(dst_contents)
+
+
+class IncrementalFormatter:
+    """
+    Formats successive versions of a module, re-using the output of the
+    top-level units that didn't change since the previous version. The
+    output is identical to `format_tree(Parser().parse(source))`.
+    """
+
+    def __init__(
+        self, max_line_length: int = 80, parser: Optional[Parser] = None
+    ):
+        self.max_line_length = max_line_length
+        self.parser = parser or Parser()
+        self._units: Dict[Tuple[bytes, bool], FormattedUnit] = {}
+        # units formatted and re-used by the last call to `format`
+        self.formatted = 0
+        self.reused = 0
+
+    def format(self, source: str) -> str:
+        units = split_units(source)
+        cache: Dict[Tuple[bytes, bool], FormattedUnit] = {}
+        self.formatted = self.reused = 0
+        formatted_units = []
+        try:
+            for i, text in enumerate(units):
+                last = i == len(units) - 1
+                key = (hashlib.sha256(text.encode("utf8")).digest(), last)
+                unit = cache.get(key) or self._units.get(key)
+                if unit is None:
+                    unit = format_unit(
+                        self.parser, text, last, self.max_line_length
+                    )
+                    self.formatted += 1
+                else:
+                    self.reused += 1
+                cache[key] = unit
+                formatted_units.append(unit)
+        except LarkError:
+            # report the error, or format what the splitting got wrong,
+            # from the whole module
+            self._units = {}
+            return format_tree(self.parser.parse(source), self.max_line_length)
+        # only keep the units of the last version
+        self._units = cache
+        return stitch_units(formatted_units)
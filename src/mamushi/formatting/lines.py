@@ -477,6 +477,23 @@ def is_line_short_enough(
     )
 
 
+def is_line_final(line: Line, line_length: int, line_str: str = "") -> bool:
+    """Return True if `split_line` would yield `line` unchanged.
+
+    That is the case of comments, and of lines that fit with no magic trailing
+    comma, no standalone comments and no power operators to hug, which can be
+    emitted without building any transformer.
+    """
+    if line.is_comment:
+        return True
+    return (
+        not line.should_split_rhs
+        and not line.magic_trailing_comma
+        and is_line_short_enough(line, line_length, line_str=line_str)
+        and not any(leaf.type == tokens.DOUBLESTAR for leaf in line.leaves)
+    )
+
+
 def can_omit_invisible_parens(
     line: Line,
     line_length: int,
@@ -786,17 +803,17 @@ def split_line(
     current `line`, possibly transitively. This means we can fallback to splitting
     by delimiters if the LHS/RHS don't yield any results.
     """
-    if line.is_comment:
+    line_str = line_to_string(line)
+    if is_line_final(line, line_length, line_str=line_str):
         yield line
         return
 
-    line_str = str(line).strip("\n")
     if (
         not line.should_split_rhs
         and not line.magic_trailing_comma
         and (is_line_short_enough(line, line_length, line_str=line_str))
-        and not (line.inside_brackets and line.contains_standalone_comments())
     ):
+        # only the power operators are left to hug
         transformers = []
 
     elif line.is_def:
@@ -0,0 +1,97 @@
+"""
+Parallel formatting of a single large module
+
+The module is cut into chunks of consecutive top-level units (see
+`mamushi.formatting.incremental`), each chunk is parsed and formatted by a
+separate worker process, and the formatted units are stitched back together
+with the empty lines of a full run.
+"""
+import multiprocessing
+from typing import List, Optional, Tuple
+
+from lark.exceptions import LarkError
+
+from mamushi.formatting.format import format_tree
+from mamushi.formatting.incremental import (
+    FormattedUnit,
+    format_unit,
+    split_units,
+    stitch_units,
+)
+from mamushi.parsing.parser import Parser
+from mamushi.utils.workers import available_cpus
+
+# files from this size (in bytes) on are split across workers by default
+DEFAULT_PARALLEL_THRESHOLD = 256 * 1024
+
+# chunks per worker, so that a slow chunk doesn't hold up the whole file
+CHUNKS_PER_WORKER = 4
+
+Chunk = List[Tuple[str, bool]]
+
+
+def make_chunks(units: List[str], count: int) -> List[Chunk]:
+    """
+    Group consecutive `units` in at most `count` chunks of similar sizes.
+    Each unit is paired with whether it is the last one of the module.
+    """
+    target = max(sum(len(unit) for unit in units) // max(count, 1), 1)
+    chunks: List[Chunk] = []
+    chunk: Chunk = []
+    size = 0
+    for i, unit in enumerate(units):
+        chunk.append((unit, i == len(units) - 1))
+        size += len(unit)
+        if size >= target:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def format_chunk(args: Tuple[Chunk, int]) -> Optional[List[FormattedUnit]]:
+    """Format the units of a chunk. Returns None if one can't be parsed."""
+    chunk, max_line_length = args
+    parser = Parser()
+    try:
+        return [
+            format_unit(parser, text, last, max_line_length)
+            for text, last in chunk
+        ]
+    except LarkError:
+        # parse errors don't always survive pickling, the error is reported
+        # by parsing the whole module instead
+        return None
+
+
+def format_in_parallel(
+    source: str,
+    max_line_length: int = 80,
+    processes: Optional[int] = None,
+) -> str:
+    """
+    Format `source` by formatting chunks of its top-level units in
+    `processes` workers (one per CPU by default). The output is identical to
+    `format_tree(Parser().parse(source))`.
+    """
+    processes = processes or available_cpus()
+    if processes < 2:
+        return format_tree(Parser().parse(source), max_line_length)
+    units = split_units(source)
+    chunks = make_chunks(units, processes * CHUNKS_PER_WORKER)
+    with multiprocessing.Pool(processes) as pool:
+        formatted = pool.map(
+            format_chunk, [(chunk, max_line_length) for chunk in chunks]
+        )
+    if any(chunk_units is None for chunk_units in formatted):
+        return format_tree(Parser().parse(source), max_line_length)
+    return stitch_units(
+        [
+            unit
+            for chunk_units in formatted
+            if chunk_units is not None
+            for unit in chunk_units
+        ]
+    )
@@ -0,0 +1,231 @@
+"""
+Restriction of formatting to ranges of lines
+
+`format_line_ranges` only renders (and splits) the logical lines that
+overlap the ranges, and copies the source lines of the others, which makes
+formatting a few lines of a large module much cheaper than formatting it all.
+The ranges are first widened to whole logical lines, and to whole top-level
+statements when their indentation changes, as formatting part of a
+statement or re-indenting part of a block would break the code.
+
+`diff_hunks` compares the output of formatting with the source line by
+line, each block of consecutive lines that formatting replaced being a
+hunk, which editors are sent as an edit.
+"""
+import bisect
+import difflib
+import re
+import sys
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from mamushi.formatting.format import render_line
+from mamushi.formatting.linegen import EmptyLineTracker, LineGenerator
+from mamushi.formatting.lines import Line
+from mamushi.parsing.pytree import Node
+
+# lines of a range, counted from 0, the end excluded
+LineRange = Tuple[int, int]
+
+_LINE = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+\Z")
+
+
+def split_lines(text: str) -> List[str]:
+    """Split `text` into lines, keeping their ending, which is a newline, a
+    carriage return or both, as for editors"""
+    return _LINE.findall(text)
+
+
+class Hunk(NamedTuple):
+    """Lines `start` to `end` (excluded) of a source, replaced by `lines`"""
+
+    start: int
+    end: int
+    lines: List[str]
+
+
+def diff_hunks(src_lines: List[str], dst_lines: List[str]) -> List[Hunk]:
+    """
+    Return the hunks that turn `src_lines` into `dst_lines`. Blocks of
+    lines replaced by as many lines are split into one hunk per line, as
+    formatting a line rarely depends on the lines around it.
+    """
+    # only the lines between those both start and end with are compared,
+    # as formatting often leaves most lines alone
+    prefix = 0
+    limit = min(len(src_lines), len(dst_lines))
+    while prefix < limit and src_lines[prefix] == dst_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while (
+        suffix < limit - prefix
+        and src_lines[-suffix - 1] == dst_lines[-suffix - 1]
+    ):
+        suffix += 1
+    dst_lines = dst_lines[prefix : len(dst_lines) - suffix]
+    matcher = difflib.SequenceMatcher(
+        None, src_lines[prefix : len(src_lines) - suffix], dst_lines, False
+    )
+    hunks = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        i1, i2 = i1 + prefix, i2 + prefix
+        if tag == "replace" and i2 - i1 == j2 - j1:
+            hunks += [
+                Hunk(i1 + k, i1 + k + 1, [dst_lines[j1 + k]])
+                for k in range(i2 - i1)
+            ]
+        else:
+            hunks.append(Hunk(i1, i2, dst_lines[j1:j2]))
+    return hunks
+
+
+def apply_hunks(src_lines: List[str], hunks: List[Hunk]) -> str:
+    """Return the source of `src_lines` with the (sorted) `hunks` applied"""
+    result = []
+    line = 0
+    for hunk in hunks:
+        result += src_lines[line : hunk.start]
+        result += hunk.lines
+        line = hunk.end
+    result += src_lines[line:]
+    return "".join(result)
+
+
+def line_span(line: Line) -> Optional[LineRange]:
+    """Return the source lines `line` was generated from, if known"""
+    first = last = 0
+    for leaf in line.leaves:
+        if leaf.lineno:
+            first = min(first or leaf.lineno, leaf.lineno)
+            last = max(last, leaf.lineno + leaf.value.count("\n"))
+    if not first:
+        return None
+    return first - 1, last
+
+
+def merge_ranges(line_ranges: List[LineRange]) -> List[LineRange]:
+    """Return the sorted union of `line_ranges`, without overlapping or
+    adjacent ranges"""
+    merged: List[LineRange] = []
+    for start, end in sorted(line_ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def overlaps(span: LineRange, merged: List[LineRange]) -> bool:
+    """Return whether `span` overlaps one of the `merged` ranges"""
+    i = bisect.bisect_left(merged, (span[1],)) - 1
+    return i >= 0 and merged[i][1] > span[0]
+
+
+def covers(merged: List[LineRange], span: LineRange) -> bool:
+    """Return whether `span` is within one of the `merged` ranges"""
+    i = bisect.bisect_right(merged, (span[0], sys.maxsize))
+    return i > 0 and merged[i - 1][1] >= span[1]
+
+
+def indentation(line: str) -> str:
+    return line[: len(line) - len(line.lstrip(" \t"))]
+
+
+def widen_ranges(
+    lines: List[Line],
+    spans: List[Optional[LineRange]],
+    src_lines: List[str],
+    line_ranges: List[LineRange],
+) -> List[LineRange]:
+    """
+    Return `line_ranges` widened to the source lines (`spans`) of the
+    logical `lines` they overlap, and to those of the top-level statement of
+    the logical lines whose indentation formatting changes, as a block is
+    either re-indented as a whole or not at all
+    """
+    # source lines of the top-level statements, by their first logical line
+    unit_spans: Dict[int, LineRange] = {}
+    units: List[int] = []
+    for i, (line, span) in enumerate(zip(lines, spans)):
+        unit = i if line.depth == 0 or not units else units[-1]
+        units.append(unit)
+        if span is not None:
+            start, end = unit_spans.get(unit, span)
+            unit_spans[unit] = min(start, span[0]), max(end, span[1])
+
+    ranges = merge_ranges(line_ranges)
+    while True:
+        widened = list(ranges)
+        # end of the source lines of the logical lines so far
+        end = 0
+        for i, (line, span) in enumerate(zip(lines, spans)):
+            if span is None:
+                continue
+            # logical lines sharing their first source line with the
+            # previous one keep its indentation
+            first = span[0] >= end
+            end = max(end, span[1])
+            if not overlaps(span, ranges):
+                continue
+            widened.append(span)
+            if first and (
+                indentation(src_lines[span[0]]) != "    " * line.depth
+            ):
+                widened.append(unit_spans[units[i]])
+        widened = merge_ranges(widened)
+        if widened == ranges:
+            return ranges
+        ranges = widened
+
+
+def format_line_ranges(
+    ast: Node,
+    source: str,
+    line_ranges: List[LineRange],
+    max_line_length: int = 80,
+) -> str:
+    """
+    Format the lines of `line_ranges` of `source`, parsed as `ast`, leaving
+    the others as they are. The logical lines of the source overlapping the
+    ranges, widened by `widen_ranges`, are formatted, along with the empty
+    lines and comments before them when the ranges cover them too, and the
+    source lines of the others are copied.
+    """
+    src_lines = split_lines(source)
+    lines = list(LineGenerator(max_line_length).visit(ast))
+    spans = [line_span(line) for line in lines]
+    line_ranges = widen_ranges(lines, spans, src_lines, line_ranges)
+    elt = EmptyLineTracker()
+    empty_line = Line()
+    after = 0
+    dst_contents: List[str] = []
+    # formatted empty lines and comments since the last logical line
+    gap: List[str] = []
+    # source lines up to this one are accounted for
+    copied = 0
+
+    for current_line, span in zip(lines, spans):
+        gap.append(str(empty_line) * after)
+        before, after = elt.maybe_empty_lines(current_line)
+        gap.append(str(empty_line) * before)
+        if span is None:
+            # standalone comments
+            gap.append(render_line(current_line, max_line_length))
+            continue
+        if overlaps(span, line_ranges):
+            if covers(line_ranges, (min(copied, span[0]), span[0])):
+                dst_contents += gap
+            else:
+                dst_contents += src_lines[copied : span[0]]
+            dst_contents.append(render_line(current_line, max_line_length))
+        else:
+            dst_contents += src_lines[copied : span[1]]
+        copied = max(copied, span[1])
+        gap = []
+
+    if covers(line_ranges, (copied, len(src_lines))):
+        dst_contents += gap
+    else:
+        dst_contents += src_lines[copied:]
+    return "".join(dst_contents)
@@ -0,0 +1,326 @@
+"""
+Language server, for editors to format documents as they are edited
+
+`mamushi lsp` speaks the Language Server Protocol over stdio. It keeps the
+text of the open documents, updated by the edits sent with each change, and
+an `IncrementalFormatter` per document, so that formatting on save only
+re-parses the top-level units that changed since the last time.
+
+Supported requests are `textDocument/formatting` and
+`textDocument/rangeFormatting`, answered with the edits of the changed
+lines, restricted to the lines of the range for the latter.
+"""
+import json
+import sys
+from typing import Any, BinaryIO, Callable, Dict, List, Optional
+
+from mamushi.__version__ import __version__
+from mamushi.formatting.incremental import IncrementalFormatter
+from mamushi.formatting.ranges import (
+    Hunk,
+    LineRange,
+    apply_hunks,
+    diff_hunks,
+    format_line_ranges,
+    split_lines,
+)
+from mamushi.parsing.comparator import find_ast_change
+from mamushi.parsing.parser import Parser
+
+# error codes of JSON-RPC and of the protocol
+METHOD_NOT_FOUND = -32601
+INVALID_REQUEST = -32600
+INTERNAL_ERROR = -32603
+REQUEST_FAILED = -32803
+
+# kinds of document synchronization
+SYNC_INCREMENTAL = 2
+
+
+class RequestFailed(Exception):
+    """Raised when a request can't be fulfilled, such as the formatting of a
+    document that can't be parsed."""
+
+
+def to_index(line: str, character: int) -> int:
+    """Convert a position in `line`, in UTF-16 code units as counted by the
+    protocol, to an index in the string"""
+    if line.isascii():
+        return min(character, len(line))
+    units = 0
+    for i, c in enumerate(line):
+        if units >= character:
+            return i
+        units += 2 if ord(c) > 0xFFFF else 1
+    return len(line)
+
+
+def to_character(line: str, index: int) -> int:
+    """Convert an index in `line` to a position in UTF-16 code units"""
+    if line.isascii():
+        return index
+    return sum(2 if ord(c) > 0xFFFF else 1 for c in line[:index])
+
+
+def content_length(line: str) -> int:
+    """Return the length of `line` without its ending"""
+    return len(line.rstrip("\r\n"))
+
+
+class Document:
+    """The text of an open document, as lines kept with their ending, which
+    edits splice in place"""
+
+    def __init__(self, text: str, version: int) -> None:
+        self.lines = split_lines(text)
+        self.version = version
+        self._text: Optional[str] = text
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = "".join(self.lines)
+        return self._text
+
+    def line(self, number: int) -> str:
+        # the position after the final line ending is on an empty line
+        return self.lines[number] if number < len(self.lines) else ""
+
+    def apply_change(self, change: Dict[str, Any]) -> None:
+        """Apply a change of a `didChange` notification"""
+        if "range" not in change:
+            self.lines = split_lines(change["text"])
+            self._text = change["text"]
+            return
+        start, end = change["range"]["start"], change["range"]["end"]
+        first = min(start["line"], len(self.lines))
+        last = min(end["line"], len(self.lines))
+        first_line, last_line = self.line(first), self.line(last)
+        text = (
+            first_line[: to_index(first_line, start["character"])]
+            + change["text"]
+            + last_line[to_index(last_line, end["character"]) :]
+        )
+        self.lines[first : last + 1] = split_lines(text)
+        self._text = None
+
+    def position(self, number: int) -> Dict[str, int]:
+        """Return the position of the start of line `number`, or of the end
+        of the document if its last line has no ending"""
+        if number == len(self.lines) and self.lines:
+            last = self.lines[-1]
+            if content_length(last) == len(last):
+                return {
+                    "line": number - 1,
+                    "character": to_character(last, len(last)),
+                }
+        return {"line": number, "character": 0}
+
+    def edit(self, hunk: Hunk) -> Dict[str, Any]:
+        """Return the text edit replacing the lines of `hunk`"""
+        return {
+            "range": {
+                "start": self.position(hunk.start),
+                "end": self.position(hunk.end),
+            },
+            "newText": "".join(hunk.lines),
+        }
+
+
+class LanguageServer:
+    """
+    Serves the requests read from `reader`, writing the responses to
+    `writer`. Documents are formatted with `line_length` and `safe`, unless
+    the client sets `lineLength` or `safe` in its initialization options.
+    """
+
+    def __init__(
+        self,
+        reader: BinaryIO,
+        writer: BinaryIO,
+        line_length: int = 80,
+        safe: bool = True,
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.line_length = line_length
+        self.safe = safe
+        self.parser = Parser()
+        self.documents: Dict[str, Document] = {}
+        self.formatters: Dict[str, IncrementalFormatter] = {}
+        self.shutting_down = False
+        self.handlers: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            "initialize": self.initialize,
+            "shutdown": self.shutdown,
+            "textDocument/didOpen": self.did_open,
+            "textDocument/didChange": self.did_change,
+            "textDocument/didClose": self.did_close,
+            "textDocument/formatting": self.formatting,
+            "textDocument/rangeFormatting": self.range_formatting,
+        }
+
+    def serve(self) -> int:
+        """Serve requests until the `exit` notification, or the end of the
+        input. Returns the exit code of the server."""
+        while True:
+            message = self.read()
+            if message is None or message.get("method") == "exit":
+                return 0 if self.shutting_down else 1
+            self.handle(message)
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        length = None
+        while True:
+            header = self.reader.readline()
+            if not header:
+                return None
+            header = header.strip()
+            if not header:
+                break
+            name, _, value = header.decode("ascii").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        if length is None:
+            return self.read()
+        return json.loads(self.reader.read(length).decode("utf8"))
+
+    def write(self, message: Dict[str, Any]) -> None:
+        body = json.dumps({"jsonrpc": "2.0", **message}).encode("utf8")
+        self.writer.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+        self.writer.flush()
+
+    def handle(self, message: Dict[str, Any]) -> None:
+        method = message.get("method")
+        params = message.get("params") or {}
+        if "id" not in message:
+            # notifications aren't answered, even when they fail
+            handler = self.handlers.get(method or "")
+            try:
+                if handler is not None:
+                    handler(params)
+            except Exception:
+                pass
+            return
+        if "method" not in message:
+            # a response to a request of the server, which sends none
+            return
+        handler = self.handlers.get(method or "")
+        if self.shutting_down:
+            self.error(
+                message["id"], INVALID_REQUEST, "The server is shutting down"
+            )
+        elif handler is None:
+            self.error(
+                message["id"],
+                METHOD_NOT_FOUND,
+                f"Unsupported method: {method}",
+            )
+        else:
+            try:
+                result = handler(params)
+            except RequestFailed as e:
+                self.error(message["id"], REQUEST_FAILED, str(e))
+            except Exception as e:
+                self.error(message["id"], INTERNAL_ERROR, repr(e))
+            else:
+                self.write({"id": message["id"], "result": result})
+
+    def error(self, request_id: Any, code: int, message: str) -> None:
+        self.write(
+            {"id": request_id, "error": {"code": code, "message": message}}
+        )
+
+    def initialize(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        options = params.get("initializationOptions") or {}
+        self.line_length = int(options.get("lineLength", self.line_length))
+        self.safe = bool(options.get("safe", self.safe))
+        return {
+            "capabilities": {
+                "positionEncoding": "utf-16",
+                "textDocumentSync": {
+                    "openClose": True,
+                    "change": SYNC_INCREMENTAL,
+                },
+                "documentFormattingProvider": True,
+                "documentRangeFormattingProvider": True,
+            },
+            "serverInfo": {"name": "mamushi", "version": __version__},
+        }
+
+    def shutdown(self, params: Dict[str, Any]) -> None:
+        self.shutting_down = True
+
+    def did_open(self, params: Dict[str, Any]) -> None:
+        document = params["textDocument"]
+        uri = document["uri"]
+        self.documents[uri] = Document(document["text"], document["version"])
+        self.formatters[uri] = IncrementalFormatter(
+            self.line_length, self.parser
+        )
+
+    def did_change(self, params: Dict[str, Any]) -> None:
+        document = self.documents[params["textDocument"]["uri"]]
+        for change in params["contentChanges"]:
+            document.apply_change(change)
+        document.version = params["textDocument"]["version"]
+
+    def did_close(self, params: Dict[str, Any]) -> None:
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.formatters.pop(uri, None)
+
+    def formatting(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return self.format_document(params["textDocument"]["uri"])
+
+    def range_formatting(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        start, end = params["range"]["start"], params["range"]["end"]
+        # a range ending at the start of a line doesn't cover it
+        last = end["line"] + (end["character"] > 0 or end == start)
+        return self.format_document(
+            params["textDocument"]["uri"], [(start["line"], last)]
+        )
+
+    def format_document(
+        self, uri: str, line_ranges: Optional[List[LineRange]] = None
+    ) -> List[Dict[str, Any]]:
+        """Return the edits formatting the document at `uri`, restricted to
+        the lines of `line_ranges` if given"""
+        if uri not in self.documents:
+            raise RequestFailed(f"Unknown document: {uri}")
+        document = self.documents[uri]
+        src = document.text
+        try:
+            if line_ranges is None:
+                dst = self.formatters[uri].format(src)
+            else:
+                dst = format_line_ranges(
+                    self.parser.parse(src), src, line_ranges, self.line_length
+                )
+        except Exception:
+            raise RequestFailed(
+                "Unable to parse the document, is the Vyper code valid?"
+            )
+        if dst == src:
+            return []
+        hunks = diff_hunks(document.lines, split_lines(dst))
+        if self.safe:
+            # the code the client gets once it applies the edits is checked
+            try:
+                change = find_ast_change(
+                    src, apply_hunks(document.lines, hunks), parser=self.parser
+                )
+            except Exception:
+                raise RequestFailed(
+                    "Formatting produced code that can't be parsed"
+                )
+            if change is not None:
+                raise RequestFailed(f"Formatting changed the AST at {change}")
+        return [document.edit(hunk) for hunk in hunks]
+
+
+def serve(line_length: int = 80, safe: bool = True) -> int:
+    """Serve over stdio, returning the exit code of the server"""
+    server = LanguageServer(
+        sys.stdin.buffer, sys.stdout.buffer, line_length, safe
+    )
+    return server.serve()
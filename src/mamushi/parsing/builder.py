@@ -0,0 +1,111 @@
+"""
+Construction of pytrees during parsing
+
+`PytreeBuilder` is passed to Lark as its tree class, so that the parser
+creates pytree nodes as it reduces rules, instead of a Lark tree that would
+have to be converted afterwards.
+"""
+import re
+from typing import Any, List, NamedTuple, Optional, Union
+
+from lark import Token, Tree
+
+from mamushi.parsing import tokens
+from mamushi.parsing.pytree import NL, Leaf, Node
+from mamushi.parsing.tokens import NEWLINE
+
+
+def break_down_comments(t: Token) -> List[Token]:
+    """Split the comments of a newline token into standalone comments"""
+    res = []
+    nlines = 0
+    newline = t.value.removeprefix("\n").rstrip(" \t").removesuffix("\n")
+    for i, line in enumerate(re.split("\n", newline)):
+        line = line.lstrip()
+        if not line:
+            nlines += 1
+        if not line.startswith("#"):
+            continue
+        res.append(
+            Token(
+                type=tokens.STANDALONE_COMMENT,
+                value=("\n" * nlines) + line,
+                line=t.line + i,  # type: ignore
+            )
+        )
+        nlines = 0
+    if res:
+        res[-1].value += "\n" * nlines
+    return res
+
+
+class Terminal(NamedTuple):
+    """Final token of a line, along with the leaves created from it"""
+
+    token: Token
+    first: Leaf
+    last: Leaf
+
+
+class PytreeBuilder:
+    """
+    Tree class of the formatting grammar, which builds pytree nodes as Lark
+    reduces rules. Tokens are converted to leaves as they are reduced, and
+    the final token of each line is recorded for the comments ignored by
+    the parser to be attached to it once the parse is done.
+
+    Like the comments collected by the lexer callbacks, the state of the
+    builder is shared by every parser of the grammar.
+    """
+
+    def __init__(self) -> None:
+        # final token of each line, indexed by line number
+        self.terminals: List[Optional[Terminal]] = []
+
+    def clear(self) -> None:
+        self.terminals.clear()
+
+    def __repr__(self) -> str:
+        # Lark hashes the repr of its options to validate its grammar cache
+        return f"{type(self).__name__}()"
+
+    def __call__(self, data: str, children: List[Any]) -> Union[Node, Tree]:
+        subnodes: List[NL] = []
+        for child in children:
+            if isinstance(child, Token):
+                self._convert_token(child, subnodes)
+            else:
+                subnodes.append(child)
+        if data.startswith("_"):
+            # Lark splices the children of inlined rules into their parent,
+            # which must be the one to adopt them
+            return Tree(data, [*subnodes])
+        return Node(type=data, children=subnodes)
+
+    def _convert_token(self, token: Token, subnodes: List[NL]) -> None:
+        if token.type in tokens.WHITESPACE and "#" in token.value:
+            leaves = [Leaf(type=token.type, value="")]
+            leaves += [
+                Leaf(type=tokens.STANDALONE_COMMENT, value=comment.value)
+                for comment in break_down_comments(token)
+            ]
+        else:
+            leaves = [Leaf(type=token.type, value=token.value)]
+        leaves[0].lineno = token.line or 0
+        subnodes += leaves
+
+        line = token.line
+        # we handle the case where a comment is the first node later
+        if not (line and token.end_pos) or (
+            token.type == NEWLINE and line == 1
+        ):
+            return
+        terminals = self.terminals
+        if line >= len(terminals):
+            terminals.extend([None] * (line + 1 - len(terminals)))
+        terminal = terminals[line]
+        if (
+            terminal is None
+            or token.end_pos >= terminal.token.end_pos  # type: ignore
+        ):
+            terminals[line] = Terminal(token, leaves[0], leaves[-1])
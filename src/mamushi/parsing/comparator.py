@@ -1,52 +1,47 @@
-from lark import Token
-from lark.visitors import Transformer_InPlaceRecursive
-
-from mamushi.parsing import tokens
-from lark import Lark, Tree
-from mamushi.parsing.parser import PythonIndenter
-
-_plain_lark_grammar = None
-
-
-class NullifyStringsAndNewLines(Transformer_InPlaceRecursive):
-    def DOCSTRING(self, args):
-        return Token(type_=tokens.DOCSTRING, value="")
-
-    def _NEWLINE(self, args):
-        return Token(type_=tokens.NEWLINE, value="")
-
-    def STRING(self, args):
-        return Token(type_=tokens.STRING, value="")
-
-
-def plain_grammar():
-    global _plain_lark_grammar
-    if _plain_lark_grammar is None:
-        return Lark.open_from_package(
-            "mamushi",
-            "grammar.lark",
-            ["parsing"],
-            parser="lalr",
-            start="module",
-            postlex=PythonIndenter(),
-            keep_all_tokens=False,
-            maybe_placeholders=False,
-        )
-
-
-def parse_string_to_tokenless_ast(code: str) -> Tree:
-    return plain_grammar().parse(code + "\n\n")
-
-
-def compare_ast(src: str, dest: str) -> bool:
+from typing import Optional
+
+from mamushi.parsing.fingerprint import (
+    Divergence,
+    Fingerprint,
+    find_divergence,
+    fingerprint_digest,
+)
+from mamushi.parsing.parser import Parser
+
+
+def find_ast_change(
+    src: str,
+    dest: str,
+    src_fingerprint: Optional[Fingerprint] = None,
+    parser: Optional[Parser] = None,
+) -> Optional[Divergence]:
+    """
+    Walks the fingerprints of the source and destination parse trees in
+    lockstep, and returns where they first diverge, if they do. The
+    fingerprint of the source is a by-product of parsing it for formatting,
+    so passing it as `src_fingerprint` saves parsing `src` a second time
+    unless the trees differ, only then being walked to find where.
+    `parser` is the parser to reuse, if any.
+
+    Each side is parsed to a full tree before it is walked, so memory grows
+    with the size of the trees, while the source fingerprint takes none.
+    """
+    parser = parser or Parser()
+    if src_fingerprint is not None:
+        dest_fingerprint = fingerprint_digest(parser.parse_events(dest))
+        if dest_fingerprint == src_fingerprint:
+            return None
+    return find_divergence(parser.parse_events(src), parser.parse_events(dest))
+
+
+def compare_ast(
+    src: str,
+    dest: str,
+    src_fingerprint: Optional[Fingerprint] = None,
+    parser: Optional[Parser] = None,
+) -> bool:
     """
-    Generates two ASTs with no punctuation tokens  and uses a transformer to
-    remove docstrings (since these are reformatted and not ignored)
-    and newlines (since we might reformat comments) then compares
-    the two trees to ensure no syntactic changes were introduced
+    Compares the fingerprints of the source and destination parse trees to
+    ensure no syntactic changes were introduced
     """
-    src_tree = parse_string_to_tokenless_ast(src)
-    dest_tree = parse_string_to_tokenless_ast(dest)
-    NullifyStringsAndNewLines().transform(src_tree)
-    NullifyStringsAndNewLines().transform(dest_tree)
-    return src_tree == dest_tree
+    return find_ast_change(src, dest, src_fingerprint, parser) is None
@@ -0,0 +1,149 @@
+"""
+Structural fingerprints of parse trees, used to check that formatting
+didn't change the AST of a contract
+"""
+import hashlib
+from dataclasses import dataclass
+from itertools import zip_longest
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from mamushi.parsing import tokens
+from mamushi.parsing.pytree import NL, Leaf, Node
+
+
+class Event(NamedTuple):
+    """A significant rule or token of a parse tree"""
+
+    # rule name or token type
+    kind: str
+    # number of significant children of a rule, value of a token
+    value: str
+    # line of the event in the parsed code, 0 if unknown
+    line: int
+    # innermost rule the event belongs to
+    rule: str
+
+
+# digest of the flattened, pre-order sequence of the significant rules and
+# tokens of a parse tree. Rules are recorded along with their number of
+# children, which makes the sequence unambiguous.
+Fingerprint = bytes
+
+
+@dataclass(frozen=True)
+class Divergence:
+    """First difference between two fingerprints"""
+
+    src: Optional[Event]
+    dest: Optional[Event]
+
+    @property
+    def line(self) -> int:
+        event = self.src or self.dest
+        return event.line if event else 0
+
+    @property
+    def rule(self) -> str:
+        event = self.src or self.dest
+        return event.rule if event else ""
+
+    def __str__(self) -> str:
+        return (
+            f"line {self.line} in `{self.rule}`: expected "
+            f"{_describe(self.src)}, found {_describe(self.dest)}"
+        )
+
+
+# tokens which formatting is allowed to add, remove or move around
+IGNORED_TOKENS = {
+    tokens.NEWLINE,
+    tokens.INDENT,
+    tokens.DEDENT,
+    tokens.COMMENT,
+    tokens.STANDALONE_COMMENT,
+    tokens.COMMA,
+    tokens.LPAR,
+    tokens.RPAR,
+}
+# tokens whose content is reformatted
+NULLIFIED_TOKENS = {tokens.STRING, tokens.DOCSTRING}
+# rule of a parenthesized expression, which is transparent once its
+# parentheses are ignored
+GROUPING_RULE = "atom"
+
+
+def _significant_children(node: Node) -> List[NL]:
+    return [
+        child
+        for child in node.children
+        if isinstance(child, Node) or child.type not in IGNORED_TOKENS
+    ]
+
+
+def _describe(event: Optional[Event]) -> str:
+    if event is None:
+        return "end of file"
+    if event.kind.islower():
+        return f"`{event.kind}` with {event.value} children"
+    return f"{event.kind} {event.value!r}"
+
+
+def iter_fingerprint(tree: Node) -> Iterator[Event]:
+    """
+    Lazily flattens a pytree of the formatting grammar, as built by the
+    parser, into its significant rules and tokens. Punctuation the formatter
+    may add or remove (trailing commas, optional parentheses), comments and
+    newlines are skipped and strings and docstrings are nullified since
+    their content is reformatted
+    """
+    stack: List[Tuple[NL, int, str]] = [(tree, 0, "")]
+    while stack:
+        node, line, rule = stack.pop()
+        if isinstance(node, Leaf):
+            value = "" if node.type in NULLIFIED_TOKENS else node.value
+            yield Event(node.type, value, node.lineno or line, rule)
+            continue
+        children = _significant_children(node)
+        while (
+            node.type == GROUPING_RULE
+            and len(children) == 1
+            and isinstance(children[0], Node)
+        ):
+            node = children[0]
+            children = _significant_children(node)
+        line = node.get_lineno() or line
+        yield Event(node.type, str(len(children)), line, rule or node.type)
+        stack.extend((child, line, node.type) for child in reversed(children))
+
+
+def fingerprint_digest(events: Iterable[Event]) -> Fingerprint:
+    """
+    Hash the kind and value of `events`, the only parts compared, so that
+    a fingerprint is kept in constant memory rather than as its events
+    """
+    digest = hashlib.sha256()
+    for kind, value, _, _ in events:
+        digest.update(f"{len(kind)}:{kind}{len(value)}:{value}".encode())
+    return digest.digest()
+
+
+def tree_fingerprint(tree: Node) -> Fingerprint:
+    return fingerprint_digest(iter_fingerprint(tree))
+
+
+def find_divergence(
+    src: Iterable[Event], dest: Iterable[Event]
+) -> Optional[Divergence]:
+    """
+    Walks two fingerprints in lockstep and returns where they first diverge,
+    or None if they are identical. Only the kind and value of events are
+    compared, since formatting moves them to other lines.
+    """
+    for src_event, dest_event in zip_longest(src, dest):
+        if (
+            src_event is None
+            or dest_event is None
+            or src_event[:2] != dest_event[:2]
+        ):
+            return Divergence(src_event, dest_event)
+    return None
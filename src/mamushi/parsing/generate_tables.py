@@ -0,0 +1,148 @@
+"""
+Generate `lalr_tables.json`, the pre-compiled parse tables shipped with mamushi
+
+Loading the tables saves compiling grammar.lark at runtime. The file must be
+regenerated whenever the grammar changes:
+
+    python -m mamushi.parsing.generate_tables
+
+The tables are written as sorted JSON, their states numbered in the order
+they are reached, so that the same grammar and version of lark always
+generate the same file.
+"""
+import json
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, Tuple
+
+import lark as lark_module
+from lark import Lark
+from lark.grammar import Rule
+from lark.lark import _LOAD_ALLOWED_OPTIONS, LarkOptions
+from lark.lexer import TerminalDef
+
+from mamushi.parsing import registry
+from mamushi.parsing.indenter import PythonIndenter
+
+TABLES_FILE = Path(__file__).with_name("lalr_tables.json")
+LINE_LENGTH = 79
+
+
+def serialize_tables(lark: Lark) -> Tuple[Dict[str, Any], Dict[int, Any]]:
+    """Serialize the parse tables of `lark`, without any runtime option"""
+    data, memo = lark.memo_serialize([TerminalDef, Rule])
+    data["options"] = {
+        name: value
+        for name, value in data["options"].items()
+        if name in LarkOptions._defaults
+        and name not in _LOAD_ALLOWED_OPTIONS
+        and name not in {"import_paths", "source_path"}
+    }
+    data["parser"]["parser"] = number_states(data["parser"]["parser"])
+    for entry in memo.values():
+        if entry["__type__"] == "TerminalDef":
+            # regex flags are kept in a set
+            entry["pattern"]["flags"] = sorted(entry["pattern"]["flags"])
+    return data, memo
+
+
+def number_states(table: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Number the states and tokens of a serialized parse table in the order
+    they are reached from its start states, rather than in the order lark
+    iterated over them, which varies between runs
+    """
+    names = table["tokens"]
+    actions = {
+        state: {names[token]: action for token, action in row.items()}
+        for state, row in table["states"].items()
+    }
+    numbers: Dict[int, int] = {}
+    pending: Deque[int] = deque(
+        state
+        for states in (table["start_states"], table["end_states"])
+        for _, state in sorted(states.items())
+    )
+    while pending:
+        state = pending.popleft()
+        if state in numbers:
+            continue
+        numbers[state] = len(numbers)
+        for _, (kind, arg) in sorted(actions[state].items()):
+            # shifts lead to another state, reductions hold a rule
+            if kind == 0:
+                pending.append(arg)
+    assert len(numbers) == len(actions), "unreachable parser states"
+    tokens = {name: i for i, name in enumerate(sorted(set(names.values())))}
+    return {
+        "tokens": {i: name for name, i in tokens.items()},
+        "states": {
+            numbers[state]: {
+                tokens[name]: (kind, numbers[arg] if kind == 0 else arg)
+                for name, (kind, arg) in row.items()
+            }
+            for state, row in actions.items()
+        },
+        "start_states": {
+            start: numbers[state]
+            for start, state in table["start_states"].items()
+        },
+        "end_states": {
+            start: numbers[state]
+            for start, state in table["end_states"].items()
+        },
+    }
+
+
+def compile_grammar(options: Dict[str, Any]) -> Lark:
+    return Lark.open_from_package(
+        "mamushi",
+        "grammar.lark",
+        ["parsing"],
+        postlex=PythonIndenter(),
+        **options,
+    )
+
+
+def generate() -> str:
+    """Return the contents of `lalr_tables.json`"""
+    tables: Dict[str, Any] = {
+        "grammar_sha256": registry.grammar_sha256(),
+        "lark_version": lark_module.__version__,
+        "tables": {},
+    }
+    for name, options in registry.GRAMMAR_OPTIONS.items():
+        data, memo = serialize_tables(compile_grammar(options))
+        tables["tables"][name] = {"data": data, "memo": memo}
+    return dumps(tables) + "\n"
+
+
+def dumps(value: Any, indent: str = "") -> str:
+    """
+    Return `value` as JSON with sorted keys, each array or object on a single
+    line if it fits in `LINE_LENGTH`, and one item per line otherwise
+    """
+    compact = json.dumps(value, sort_keys=True)
+    if (
+        not isinstance(value, (dict, list, tuple))
+        or not value
+        or len(indent) + len(compact) <= LINE_LENGTH
+    ):
+        return compact
+    inner = indent + " "
+    if isinstance(value, dict):
+        items = [
+            f"{inner}{json.dumps(str(key))}: {dumps(item, inner)}"
+            for key, item in sorted(value.items())
+        ]
+        return "{\n" + ",\n".join(items) + f"\n{indent}}}"
+    items = [inner + dumps(item, inner) for item in value]
+    return "[\n" + ",\n".join(items) + f"\n{indent}]"
+
+
+def main() -> None:
+    TABLES_FILE.write_text(generate(), encoding="utf8")
+
+
+if __name__ == "__main__":
+    main()
@@ -25,10 +25,14 @@ class Indenter(PostLex, ABC):
     processed_newlines: List[Token]
 
     def __init__(self) -> None:
+        self.reset()
+        assert self.tab_len > 0
+
+    def reset(self) -> None:
+        """Forget the state left by the last token stream"""
         self.paren_level = 0
         self.indent_level = [0]
         self.processed_newlines = []
-        assert self.tab_len > 0
 
     @staticmethod
     def create_dent_on_next_line(
@@ -159,9 +163,7 @@ class Indenter(PostLex, ABC):
         assert self.indent_level == [0], self.indent_level
 
     def process(self, stream):
-        self.paren_level = 0
-        self.indent_level = [0]
-        self.processed_newlines = []
+        self.reset()
         return self._process(stream)
 
     # XXX Hack for ContextualLexer. Maybe there's a more elegant solution?
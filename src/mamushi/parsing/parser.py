@@ -1,285 +1,208 @@
 # EXPERIMENTAL VYPER PARSER
 # https://github.com/vyperlang/vyper/
+import gc
 import re
 from collections import defaultdict
-from typing import Any, Dict, List, Tuple
-
-from lark import Lark, Token, Tree
-
-from mamushi.parsing import tokens
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from lark import Token
+
+from mamushi.parsing import registry, tokens
+from mamushi.parsing.builder import Terminal, break_down_comments
+from mamushi.parsing.fingerprint import (
+    Event,
+    Fingerprint,
+    iter_fingerprint,
+    tree_fingerprint,
+)
 from mamushi.parsing.indenter import PythonIndenter
-from mamushi.parsing.pytree import Leaf, Node
+from mamushi.parsing.pytree import NL, Leaf, Node
 from mamushi.parsing.tokens import NEWLINE
 
-CommentMapping = Dict[Tuple[Any, ...], Token]
-StandAloneCommentMapping = Dict[Tuple[Any, ...], List[Token]]
 DedentCount = Dict[Tuple[Any, ...], int]
 
+COMMENT_TYPES = {tokens.COMMENT, tokens.STANDALONE_COMMENT}
+
+
+@contextmanager
+def gc_paused() -> Iterator[None]:
+    """
+    Pause the garbage collector while building a large number of objects
+    that are all kept alive, which would otherwise trigger collections that
+    have nothing to free
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 
 class Parser(object):
     """
-    Parse a vyper file using lark, converts the lark tree to a pytree
+    Parse a vyper file using lark, which builds a pytree as it goes
     Lalr needs comments that aren't parsed along with newlines to be ignored
-    We collect those with callbacks and then reintegrate them during the
-    conversion to pytree
+    We collect those with callbacks and then reintegrate them in the pytree
+    once it is built
     """
 
     def __init__(self):
-        self._comments = []
-        self._all_newlines = []
-        self._comment_mapping: CommentMapping = {}
-        self._orphan_comment_mapping: StandAloneCommentMapping = defaultdict(
-            list
-        )
+        # the compiled grammar, along with the comments and newlines its
+        # lexer callbacks collect and the final tokens of the lines its tree
+        # builder records, is shared by all parsers of the process
+        self._grammar = registry.formatting_grammar()
+        self._comments = self._grammar.comments
+        self._all_newlines = self._grammar.newlines
+        self._terminals = self._grammar.builder.terminals
         self._header_comments: List[Token] = []
-        self.indenter = PythonIndenter()
-        self.lalr = self._create_lalr_parser()
-
-    def _create_lalr_parser(self):
-        return Lark.open_from_package(
-            "mamushi",
-            "grammar.lark",
-            ["parsing"],
-            parser="lalr",
-            start="module",
-            postlex=self.indenter,
-            keep_all_tokens=True,
-            propagate_positions=True,
-            lexer_callbacks={
-                "COMMENT": self._comments.append,
-                "_NEWLINE": self._record_all_newlines,
-            },
-            maybe_placeholders=False,
-        )
-
-    def _record_all_newlines(self, token: Token):
-        self._all_newlines.append(token)
-        return token
+        self.indenter: PythonIndenter = self._grammar.indenter
+        self.lalr = self._grammar.lark
+        # fingerprint of the last parsed tree, when requested
+        self.last_fingerprint: Optional[Fingerprint] = None
 
     @staticmethod
-    def _preprocess(code: str) -> str:
-        return re.sub(r"[ \t]+\n", "\n", code, re.MULTILINE) + "\n"
+    def preprocess(code: str) -> str:
+        return re.sub(r"[ \t]+\n", "\n", code) + "\n"
 
     def _clear_comments(self):
-        self._comments.clear()
-        self._comment_mapping.clear()
-        self._orphan_comment_mapping.clear()
+        self._grammar.clear()
         self._header_comments.clear()
-        self._all_newlines.clear()
 
-    def parse(self, code):
-        self._clear_comments()
-        lark_tree = self.lalr.parse(self._preprocess(code))
-        self._generate_comment_associations(lark_tree)
-        pytree = self._to_pytree(lark_tree)
+    def parse(self, code, fingerprint: bool = False):
+        """
+        Parse `code` to a pytree. If `fingerprint` is set, the fingerprint of
+        the tree is kept as `last_fingerprint` to compare ASTs in safe mode
+        """
+        with self._grammar.lock, gc_paused():
+            self._clear_comments()
+            try:
+                pytree = self.lalr.parse(self.preprocess(code))
+                self._attach_comments(pytree)
+            finally:
+                # don't keep the tokens of the file alive until the next one
+                self._clear_comments()
+        self.last_fingerprint = (
+            tree_fingerprint(pytree) if fingerprint else None
+        )
         return pytree
 
-    @staticmethod
-    def _break_down_comments(t: Token) -> List[Token]:
-        res = []
-        nlines = 0
-        newline = t.value.removeprefix("\n").rstrip(" \t").removesuffix("\n")
-        for i, line in enumerate(re.split("\n", newline)):
-            line = line.lstrip()
-            if not line:
-                nlines += 1
-            if not line.startswith("#"):
-                continue
-            res.append(
-                Token(
-                    type=tokens.STANDALONE_COMMENT,
-                    value=("\n" * nlines) + line,
-                    line=t.line + i,  # type: ignore
-                )
-            )
-            nlines = 0
-        if res:
-            res[-1].value += "\n" * nlines
-        return res
+    def parse_events(self, code: str) -> Iterator[Event]:
+        """
+        Parse `code` and lazily walk the fingerprint of its tree, skipping
+        the comments, which the fingerprint ignores. The whole tree is built
+        before the first event is yielded
+        """
+        with self._grammar.lock, gc_paused():
+            try:
+                pytree = self.lalr.parse(self.preprocess(code))
+            finally:
+                # the comments and newlines collected are of no use here
+                self._clear_comments()
+        return iter_fingerprint(pytree)
 
-    @staticmethod
-    def _token_id(token: Token) -> Tuple[Any, ...]:
-        return (
-            token.value,
-            token.type,
-            token.column,
-            token.end_pos,
-            token.line,
-        )
+    _break_down_comments = staticmethod(break_down_comments)
 
-    def _generate_comment_associations(self, tree: Tree):
+    def _attach_comments(self, module: Node) -> None:
         """
-        Run a BFS on the tree to find the final leaves of each lines
-        where we can append the ignored comments in the final tree
-        return a mapping of leaves to comment
+        Insert the comments ignored by the parser in the pytree, after the
+        leaves of the final token of their line. The comments, sorted by
+        line, are merged with the lines that have a final token, which runs
+        in time linear in the number of tokens and comments, and the
+        children of each node that receives comments are rebuilt once.
         """
 
-        # handle trailing comments first
+        # comments and newlines are collected in source order, and sorting
+        # already sorted tokens is linear
         comments = self._comments
-        comments.sort(key=lambda c: c.line)
-        cmt_idx = {c.line: c for c in comments}
+        comments.sort(key=lambda c: c.line or 0)
 
         # retrieve orphaned comments from ignored newlines
         # these are usually comments in between arguments to a call
-        orphaned_comments = list(
-            set(self._all_newlines) - set(self.indenter.processed_newlines)
-        )
+        # tokens compare by value, and identical newlines can be both
+        # processed and ignored in the same file
+        processed = {id(t) for t in self.indenter.processed_newlines}
         orphaned_comments = [
             el
-            for t in orphaned_comments
+            for t in self._all_newlines
+            if id(t) not in processed and "#" in t
             for el in self._break_down_comments(t)
-            if "#" in t
         ]
-        orphaned_comments.sort(key=lambda c: c.line)
-        o_cmt_idx = {c.line: c for c in orphaned_comments}
-
-        queue = [tree]
-        terminal_leaves: Dict[
-            int, Token
-        ] = {}  # parent node and index of child
-
-        # we first traverse to find the last token on each potentially relevant line
-        while queue:
-            node = queue.pop()
-            # if the node does not cover any lines with comments
-            # or is a leaf, we can skip
-            if isinstance(node, Token):
-                continue
-            for i, child in enumerate(node.children):
-                if (
-                    isinstance(child, Token)
-                    and (child.line and child.end_pos)
-                    and (
-                        child.line not in terminal_leaves
-                        or child.end_pos  # type: ignore
-                        >= terminal_leaves[child.line].end_pos
-                    )
-                ):
-                    # we handle the case where a comment is the first node later
-                    if child.type == NEWLINE and child.line == 1:
-                        continue
-                    else:
-                        terminal_leaves[child.line] = child
-                else:
-                    queue.append(child)
+        orphaned_comments.sort(key=lambda c: c.line or 0)
+
+        terminals = self._terminals
+        # leaves to insert before and after the leaves of a token, keyed by
+        # the identity of its first and last leaves
+        before: Dict[int, List[Leaf]] = defaultdict(list)
+        after: Dict[int, List[Leaf]] = defaultdict(list)
+        parents: Dict[int, Node] = {}
+
+        def attach(terminal: Terminal, leaf: Leaf, trailing: bool) -> None:
+            # comments tokens kept by the parser are already in the tree
+            if terminal.token.type in COMMENT_TYPES:
+                return
+            # if the token is a newline, we want the trailing comment BEFORE
+            if trailing and terminal.token.type == NEWLINE:
+                before[id(terminal.first)].append(leaf)
+                anchor = terminal.first
+            else:
+                after[id(terminal.last)].append(leaf)
+                anchor = terminal.last
+            if anchor.parent is not None:
+                parents[id(anchor.parent)] = anchor.parent
 
-        # create a mapping for trailing comments
-        self._comment_mapping = {
-            self._token_id(t): cmt_idx[line]
-            for line, t in terminal_leaves.items()
-            if line in cmt_idx
-        }
+        # handle trailing comments first
+        for comment in comments:
+            line = comment.line or 0
+            terminal = terminals[line] if line < len(terminals) else None
+            if terminal is not None:
+                attach(
+                    terminal,
+                    Leaf(type=comment.type, value=comment.value),
+                    trailing=True,
+                )
 
         # we need to handle the case where the first line is a comment
-        if comments and comments[0].line == 1 and 1 not in terminal_leaves:
-            self._header_comments = [cmt_idx[1]]
-
-        # handle the orphaned comments last
-        for (
-            line,
-            comment,
-        ) in o_cmt_idx.items():  # o_cmt_idx is sorted (p3.6+)
-            attach_line = line
-            while attach_line not in terminal_leaves:
-                attach_line -= 1
-                if attach_line < 0:
-                    self._header_comments.append(comment)
-                    break
-            if attach_line < 0:
-                continue
-            t = terminal_leaves[attach_line]
-            key_token = (t.value, t.type, t.column, t.end_pos, t.line)
-            self._orphan_comment_mapping[key_token].append(comment)
-
-    def _to_pytree(self, lark_tree: Tree) -> Node:
-        def _transform(tree: Tree):
-            """
-            Convert a Lark tree to Pytree
-            """
-            subnodes = []
-            for i, child in enumerate(tree.children):
-                if isinstance(child, Tree):
-                    subnodes.append(_transform(child))
-
-                else:
-                    # we store the original cursor of the subnodes
-                    # for when we need to insert comments beforehand (whitespace)
-                    subnode_cursor = len(subnodes)
-
-                    if child.type in tokens.WHITESPACE and "#" in child.value:
-                        subnodes.append(
-                            Leaf(
-                                type=child.type,
-                                value="",
-                            )
-                        )
-                        for comment in self._break_down_comments(child):
-                            subnodes.append(
-                                Leaf(
-                                    type=tokens.STANDALONE_COMMENT,
-                                    value=comment.value,
-                                )
-                            )
-
-                    else:
-                        # append current child to list of subnodes
-                        subnodes.append(
-                            Leaf(
-                                type=child.type,
-                                value=child.value,
-                            )
-                        )
-
-                    # process any potential trailing comments
-                    child_id = (
-                        self._token_id(child)
-                        if child.type
-                        not in {tokens.COMMENT, tokens.STANDALONE_COMMENT}
-                        else ("", "", 0, 0)
-                    )
-
-                    if (
-                        self._comment_mapping
-                        and child_id in self._comment_mapping
-                    ):
-                        comment = self._comment_mapping[child_id]
-                        # if the current node is a newline, we want the trailing comment BEFORE
-                        if child.type == NEWLINE:
-                            subnodes.insert(
-                                subnode_cursor,
-                                Leaf(type=comment.type, value=comment.value),
-                            )
-                            subnode_cursor += 1
-                        else:
-                            subnodes.append(
-                                Leaf(type=comment.type, value=comment.value)
-                            )
-
-                    # handle the standalone comments last
-                    if (
-                        self._orphan_comment_mapping
-                        and child_id in self._orphan_comment_mapping
-                    ):
-                        subnodes += [
-                            Leaf(type=c.type, value=c.value)
-                            for c in self._orphan_comment_mapping[child_id]
-                        ]
-
-            node = Node(type=tree.data, children=[])
-            for leaf in subnodes:
-                node.append_child(leaf)
-            return node
+        if (
+            comments
+            and comments[0].line == 1
+            and (len(terminals) < 2 or terminals[1] is None)
+        ):
+            self._header_comments = [comments[0]]
+
+        # handle the orphaned comments last, attaching each to the final
+        # token of the closest line above it
+        attach_to: Optional[Terminal] = None
+        line = 0
+        for comment in orphaned_comments:
+            comment_line = comment.line or 0
+            while line <= comment_line and line < len(terminals):
+                attach_to = terminals[line] or attach_to
+                line += 1
+            if attach_to is None:
+                self._header_comments.append(comment)
+            else:
+                attach(
+                    attach_to,
+                    Leaf(type=comment.type, value=comment.value),
+                    trailing=False,
+                )
 
-        module = _transform(lark_tree)
+        for parent in parents.values():
+            children: List[NL] = []
+            for child in parent.children:
+                children += before.get(id(child), ())
+                children.append(child)
+                children += after.get(id(child), ())
+            for child in children:
+                child.parent = parent
+            parent.children = children
+            parent.invalidate_sibling_maps()
 
         self._header_comments.sort(key=lambda x: x.line, reverse=True)  # type: ignore
         for c in self._header_comments:
-            module.children.insert(
-                0,
-                Leaf(
-                    type=c.type,
-                    value=c.value,
-                ),
-            )
-
-        return module
+            header = Leaf(type=c.type, value=c.value)
+            header.lineno = c.line or 0
+            module.children.insert(0, header)
@@ -0,0 +1,198 @@
+"""
+Process-wide registry of the Lark parsers built from grammar.lark
+
+Compiling the grammar is by far the most expensive part of setting up a
+parser, so each registered grammar is built at most once per process and
+shared by every `Parser`, `compare_ast` call and any other entry point.
+
+The parse tables are loaded from the pre-generated `lalr_tables.json` when
+it is in sync with grammar.lark and the installed lark, and only compiled
+(through lark's on-disk cache) otherwise.
+"""
+import hashlib
+import json
+import pkgutil
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import lark as lark_module
+from lark import Lark, Token
+
+from mamushi.parsing.builder import PytreeBuilder
+from mamushi.parsing.indenter import PythonIndenter
+from mamushi.utils.cache import grammar_cache_file
+
+# options of the parser, which keeps every token for formatting
+LALR_OPTIONS: Dict[str, Any] = dict(
+    parser="lalr",
+    start="module",
+    keep_all_tokens=True,
+    maybe_placeholders=False,
+)
+
+FORMATTING = "formatting"
+
+GRAMMAR_OPTIONS: Dict[str, Dict[str, Any]] = {
+    FORMATTING: LALR_OPTIONS,
+}
+
+# number of times each grammar was compiled in the current process
+COMPILATIONS: Counter = Counter()
+
+
+@dataclass
+class Grammar:
+    """
+    A compiled Lark parser along with the state its postlexer, lexer
+    callbacks and tree builder write to. The state is shared by every user
+    of the grammar, so parsing must hold `lock` until it has consumed that
+    state.
+    """
+
+    lark: Lark
+    indenter: PythonIndenter
+    comments: List[Token] = field(default_factory=list)
+    newlines: List[Token] = field(default_factory=list)
+    builder: PytreeBuilder = field(default_factory=PytreeBuilder)
+    lock: threading.RLock = field(default_factory=threading.RLock)
+
+    def clear(self) -> None:
+        self.comments.clear()
+        self.newlines.clear()
+        self.builder.clear()
+        self.indenter.reset()
+
+
+_grammars: Dict[str, Grammar] = {}
+_registry_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def grammar_source() -> bytes:
+    return pkgutil.get_data("mamushi", "parsing/grammar.lark") or b""
+
+
+def grammar_sha256() -> str:
+    return hashlib.sha256(grammar_source()).hexdigest()
+
+
+def _int_keys(pairs: List[Tuple[str, Any]]) -> Dict[Any, Any]:
+    # JSON objects only have string keys, while lark numbers its memo, tokens
+    # and states
+    return {int(key) if key.isdigit() else key: value for key, value in pairs}
+
+
+def read_tables() -> Optional[Dict[str, Any]]:
+    """Return the contents of `lalr_tables.json`, or None if it is missing
+    or corrupted"""
+    try:
+        source = pkgutil.get_data("mamushi", "parsing/lalr_tables.json")
+        return json.loads(source or b"null", object_pairs_hook=_int_keys)
+    except (OSError, ValueError):
+        return None
+
+
+def _load_tables(name: str, **options: Any) -> Optional[Lark]:
+    """
+    Load grammar `name` from the pre-generated tables. Returns None if they
+    are missing, out of sync with grammar.lark or were generated by an
+    incompatible version of lark.
+    """
+    tables = read_tables()
+    if tables is None or tables["grammar_sha256"] != grammar_sha256():
+        return None
+    if (
+        tables["lark_version"].split(".")[:2]
+        != lark_module.__version__.split(".")[:2]
+    ):
+        return None
+    serialized = tables["tables"].get(name)
+    if serialized is None:
+        return None
+    try:
+        return Lark._load_from_dict(
+            serialized["data"], serialized["memo"], **options
+        )
+    except Exception:
+        # stale or corrupted tables: fall back to compiling the grammar
+        return None
+
+
+def _compile(name: str, **runtime_options: Any) -> Lark:
+    options = GRAMMAR_OPTIONS[name]
+    lark = _load_tables(name, **runtime_options)
+    if lark is None:
+        lark = Lark.open_from_package(
+            "mamushi",
+            "grammar.lark",
+            ["parsing"],
+            cache=grammar_cache_file(grammar_source(), **options),
+            **runtime_options,
+            **options,
+        )
+    return lark
+
+
+def _build_formatting_grammar() -> Grammar:
+    indenter = PythonIndenter()
+    builder = PytreeBuilder()
+    comments: List[Token] = []
+    newlines: List[Token] = []
+
+    def record_newline(token: Token) -> Token:
+        newlines.append(token)
+        return token
+
+    lark = _compile(
+        FORMATTING,
+        postlex=indenter,
+        lexer_callbacks={
+            "COMMENT": comments.append,
+            "_NEWLINE": record_newline,
+        },
+        # the parser builds pytrees rather than Lark trees
+        tree_class=builder,
+    )
+    return Grammar(lark, indenter, comments, newlines, builder)
+
+
+_BUILDERS = {
+    FORMATTING: _build_formatting_grammar,
+}
+
+
+def get_grammar(name: str) -> Grammar:
+    """Return the grammar registered as `name`, building it on first use"""
+    grammar: Optional[Grammar] = _grammars.get(name)
+    if grammar is None:
+        with _registry_lock:
+            grammar = _grammars.get(name)
+            if grammar is None:
+                grammar = _BUILDERS[name]()
+                COMPILATIONS[name] += 1
+                _grammars[name] = grammar
+    return grammar
+
+
+def formatting_grammar() -> Grammar:
+    return get_grammar(FORMATTING)
+
+
+def compilation_count(name: Optional[str] = None) -> int:
+    """
+    Return how many times `name` (or any grammar, if omitted) was built in
+    this process, whether from the pre-generated tables or by compiling it.
+    Building only happens once per grammar and process.
+    """
+    if name is None:
+        return sum(COMPILATIONS.values())
+    return COMPILATIONS[name]
+
+
+def reset() -> None:
+    """Drop every registered grammar, forcing them to be built again"""
+    with _registry_lock:
+        _grammars.clear()
@@ -0,0 +1,197 @@
+"""Shared stores of formatted outputs.
+
+A backend maps the key of a source, which covers its contents and the
+options it was formatted with, to its formatted output. The outputs
+produced by a run can then be reused by every run sharing the backend,
+whether on the same machine (`LocalBackend`) or across a CI fleet
+(`HTTPBackend`).
+
+Lookups are issued concurrently in the background, and a run never waits
+for them: the files whose lookup hasn't completed by the time a worker is
+ready to format them are formatted as if there was no backend.
+"""
+import hashlib
+import os
+import queue
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from mamushi.__version__ import __version__
+
+# seconds a single request to a backend may take
+REQUEST_TIMEOUT = 5.0
+
+# seconds the end of a run waits for lookups still in flight, after which
+# the backend is deemed unresponsive and the outputs aren't waited to be stored
+ANSWER_TIMEOUT = 0.5
+
+# requests to a backend in flight at once
+MAX_CONCURRENT_REQUESTS = 16
+
+
+def entry_key(source: bytes, line_length: int, safe: bool) -> str:
+    """Return the key of the formatted output of `source`"""
+    options = f"mamushi {__version__} {line_length} {int(safe)}\n"
+    return hashlib.sha256(options.encode("utf8") + source).hexdigest()
+
+
+# a call to make, along with the future of its result
+Task = Tuple[Future, Callable[..., Any], Tuple[Any, ...]]
+
+
+class RequestRunner:
+    """Runs requests in daemon threads, so that requests to a slow backend
+    that are still in flight never hold up the exit of the interpreter"""
+
+    def __init__(self, threads: int = MAX_CONCURRENT_REQUESTS) -> None:
+        self._queue: "queue.SimpleQueue[Optional[Task]]" = queue.SimpleQueue()
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True)
+            for _ in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn: Callable, *args: Any) -> Future:
+        future: Future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def shutdown(self) -> None:
+        """Cancel the requests that didn't start yet"""
+        while True:
+            try:
+                task = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if task is not None:
+                task[0].cancel()
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def _run(self) -> None:
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            future, fn, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class CacheBackend(ABC):
+    """A content-addressed store of formatted outputs"""
+
+    def __init__(self) -> None:
+        self._requests = RequestRunner()
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the entry stored under `key`, if any"""
+
+    @abstractmethod
+    def put(self, key: str, value: bytes) -> None:
+        """Store `value` under `key`"""
+
+    def lookup_many(
+        self, keys: Iterable[str]
+    ) -> Dict[str, "Future[Optional[bytes]]"]:
+        """Start looking up `keys`, without waiting for the results"""
+        return {key: self._requests.submit(self._get, key) for key in keys}
+
+    def store(self, key: str, value: bytes) -> Future:
+        """Start storing `value` under `key`, without waiting for it"""
+        return self._requests.submit(self._put, key, value)
+
+    def close(self) -> None:
+        """Drop the requests that didn't start yet"""
+        self._requests.shutdown()
+
+    def _get(self, key: str) -> Optional[bytes]:
+        # an unavailable backend is as good as an empty one
+        try:
+            return self.get(key)
+        except Exception:
+            return None
+
+    def _put(self, key: str, value: bytes) -> None:
+        try:
+            self.put(key, value)
+        except Exception:
+            pass
+
+
+class LocalBackend(CacheBackend):
+    """Entries stored as files of a directory, possibly shared over a
+    network filesystem"""
+
+    def __init__(self, root: Path) -> None:
+        super().__init__()
+        self.root = root
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # readers never see partially written entries
+        with tempfile.NamedTemporaryFile(
+            dir=str(path.parent), delete=False
+        ) as f:
+            f.write(value)
+        os.replace(f.name, path)
+
+
+class HTTPBackend(CacheBackend):
+    """Entries stored on an HTTP server, which answers `GET <url>/<key>`
+    with the entry (or 404), and stores the body of `PUT <url>/<key>`"""
+
+    def __init__(self, url: str, timeout: float = REQUEST_TIMEOUT) -> None:
+        super().__init__()
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with urllib.request.urlopen(
+                f"{self.url}/{key}", timeout=self.timeout
+            ) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def put(self, key: str, value: bytes) -> None:
+        request = urllib.request.Request(
+            f"{self.url}/{key}",
+            data=value,
+            method="PUT",
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+def get_backend(location: str) -> CacheBackend:
+    """Return the backend at `location`, an HTTP(S) URL or a directory"""
+    if location.startswith(("http://", "https://")):
+        return HTTPBackend(location)
+    return LocalBackend(Path(location))
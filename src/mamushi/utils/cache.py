@@ -0,0 +1,400 @@
+"""Caching of mamushi's on-disk artifacts."""
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import lark
+
+from mamushi.__version__ import __version__
+
+
+def get_cache_dir() -> Path:
+    """Get the cache directory used by mamushi.
+
+    Users can customize this directory on all systems using the
+    `MAMUSHI_CACHE_DIR` environment variable. By default, the cache directory
+    is the user cache directory of the platform, under a sub-directory named
+    after the current mamushi version.
+
+    This result is immediately set to a constant `mamushi.utils.cache.CACHE_DIR`
+    as to avoid repeated calls.
+    """
+    default_cache_dir = os.environ.get("MAMUSHI_CACHE_DIR")
+    if default_cache_dir:
+        return Path(default_cache_dir) / __version__
+
+    if sys.platform == "win32":
+        base = Path(
+            os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+        )
+        return base / "mamushi" / "Cache" / __version__
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "mamushi" / __version__
+    base = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return base / "mamushi" / __version__
+
+
+CACHE_DIR = get_cache_dir()
+
+
+def grammar_cache_file(grammar: bytes, **options: Any) -> Union[str, bool]:
+    """Return the file Lark should cache the compiled LALR tables in.
+
+    The file name is keyed by the hash of the `grammar`, the lark and
+    python versions and the (hashable) parser `options`, so that a change
+    to any of them never picks up stale tables. Returns False, which
+    disables Lark's cache, if the cache directory can't be created.
+    """
+    key = "".join(f"{name}={options[name]!r};" for name in sorted(options))
+    digest = hashlib.sha256(
+        grammar
+        + key.encode("utf8")
+        + lark.__version__.encode("utf8")
+        + str(sys.version_info[:2]).encode("utf8")
+    ).hexdigest()
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return False
+    return str(CACHE_DIR / f"grammar.{digest[:32]}.lark")
+
+
+# most entries of each kind the formatting cache keeps, the least recently
+# used ones being evicted first
+MAX_CACHE_ENTRIES = 100_000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    options TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (options, digest)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    options TEXT NOT NULL,
+    path TEXT NOT NULL,
+    st_mtime_ns INTEGER NOT NULL,
+    st_size INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (options, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used);
+CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used);
+"""
+
+# most values looked up by a single query, within the number of parameters
+# any version of sqlite allows
+_BATCH_SIZE = 500
+
+
+def get_cache_file() -> Path:
+    """Return the database the formatting cache is kept in.
+
+    The cache directory is already specific to the current mamushi version.
+    """
+    return CACHE_DIR / "cache.sqlite3"
+
+
+@contextmanager
+def open_cache_db() -> Iterator[sqlite3.Connection]:
+    """Open the formatting cache database, creating it if needed.
+
+    Concurrent runs wait for each other's transactions, which are atomic.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = get_cache_file()
+    connection = sqlite3.connect(str(path), timeout=30)
+    try:
+        try:
+            connection.executescript(_SCHEMA)
+        except sqlite3.DatabaseError as e:
+            if isinstance(e, sqlite3.OperationalError):
+                raise
+            # not a database: start over with an empty one
+            connection.close()
+            path.unlink()
+            connection = sqlite3.connect(str(path), timeout=30)
+            connection.executescript(_SCHEMA)
+        yield connection
+    finally:
+        connection.close()
+
+
+def hash_digest(path: Path) -> str:
+    """Return the hash digest of the contents of the file at `path`."""
+    with open(path, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+class FileData(NamedTuple):
+    """Stat data of a file when its contents were last hashed."""
+
+    st_mtime_ns: int
+    st_size: int
+    digest: str
+
+
+@dataclass
+class Cache:
+    """Digests of the file contents known to be formatted.
+
+    The cache is specific to the options that change the output of mamushi
+    (`line_length`) or whether it was verified (`safe`), so that contents
+    formatted with other options are formatted again.
+
+    The stat data of the files last seen formatted is kept along with their
+    digest, so that a file whose modification time and size didn't change
+    is known formatted without being opened.
+    """
+
+    line_length: int
+    safe: bool
+    digests: Set[str] = field(default_factory=set)
+    files: Dict[str, FileData] = field(default_factory=dict)
+    # file data of the files hashed by this instance
+    hashed: Dict[str, FileData] = field(default_factory=dict)
+
+    @property
+    def options(self) -> str:
+        return f"{self.line_length}.{int(self.safe)}"
+
+    @classmethod
+    def read(
+        cls, line_length: int, safe: bool, sources: Iterable[Path]
+    ) -> "Cache":
+        """Read the entries of the cache for the given options and `sources`.
+
+        Only the entries of the `sources`, and of the contents of those whose
+        stat data changed since they were last seen formatted, are read. If
+        the database can't be read, the cache is empty, and the call to write
+        later should resolve the issue.
+        """
+        cache = cls(line_length, safe)
+        if not get_cache_file().exists():
+            return cache
+        paths = {os.path.abspath(src): src for src in sources}
+        try:
+            with open_cache_db() as db:
+                files = {
+                    path: FileData(*data)
+                    for path, *data in _select_in(
+                        db,
+                        "SELECT path, st_mtime_ns, st_size, digest FROM files"
+                        " WHERE options = ? AND path IN ({})",
+                        cache.options,
+                        paths,
+                    )
+                }
+                changed: Set[str] = set()
+                for path, src in paths.items():
+                    try:
+                        if not _unchanged(files.get(path), src.stat()):
+                            changed.add(cache.hashed_data(src).digest)
+                    except OSError:
+                        continue
+                digests = _select_in(
+                    db,
+                    "SELECT digest FROM digests"
+                    " WHERE options = ? AND digest IN ({})",
+                    cache.options,
+                    changed,
+                )
+        except (sqlite3.Error, OSError):
+            return cache
+        cache.digests = {digest for digest, in digests}
+        cache.files = files
+        return cache
+
+    @staticmethod
+    def get_file_data(path: Path) -> FileData:
+        """Return file data for the file at `path`, hashing its contents."""
+        stat = path.stat()
+        return FileData(stat.st_mtime_ns, stat.st_size, hash_digest(path))
+
+    def hashed_data(self, path: Path) -> FileData:
+        """Return file data for the file at `path`, only hashing its contents
+        if they weren't hashed since it last changed."""
+        key = os.path.abspath(path)
+        data = self.hashed.get(key)
+        if not _unchanged(data, path.stat()):
+            data = self.hashed[key] = self.get_file_data(path)
+        assert data is not None
+        return data
+
+    def is_formatted(self, path: Path) -> bool:
+        """Check if the contents of the file at `path` are known formatted.
+
+        The file is only opened if its stat data changed since it was last
+        seen formatted, or if it was never seen.
+        """
+        try:
+            if _unchanged(self.files.get(os.path.abspath(path)), path.stat()):
+                return True
+            return self.hashed_data(path).digest in self.digests
+        except OSError:
+            return False
+
+    def filtered_cached(
+        self, sources: Iterable[Path]
+    ) -> Tuple[List[Path], List[Path]]:
+        """Split an iterable of paths in `sources` into two lists.
+
+        The first contains paths of files whose contents aren't known to be
+        formatted, the second contains paths of files known formatted.
+        """
+        todo: List[Path] = []
+        done: List[Path] = []
+        for src in sources:
+            (done if self.is_formatted(src) else todo).append(src)
+        return todo, done
+
+    def write(self, sources: Iterable[Path]) -> None:
+        """Record `sources` as formatted, in a single transaction.
+
+        Only the files whose stat data changed since they were last hashed
+        are hashed again. Every entry
+        of `sources` is marked as used, and the least recently used entries
+        beyond `MAX_CACHE_ENTRIES` are evicted.
+        """
+        files: Dict[str, FileData] = {}
+        for src in sources:
+            key = os.path.abspath(src)
+            try:
+                data = self.files.get(key)
+                if not _unchanged(data, src.stat()):
+                    data = self.hashed_data(src)
+            except OSError:
+                continue
+            assert data is not None
+            files[key] = data
+        if not files:
+            return
+        now = time.time_ns()
+        try:
+            with open_cache_db() as db, db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?)",
+                    [
+                        (self.options, digest, now)
+                        for digest in {data.digest for data in files.values()}
+                    ],
+                )
+                db.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (self.options, path, *data, now)
+                        for path, data in files.items()
+                    ],
+                )
+                _evict(db, MAX_CACHE_ENTRIES)
+        except (sqlite3.Error, OSError):
+            return
+        self.digests.update(data.digest for data in files.values())
+        self.files.update(files)
+
+
+def _unchanged(data: Optional[FileData], stat: os.stat_result) -> bool:
+    """Check if the stat data of a file is still the one in `data`"""
+    return (
+        data is not None
+        and data.st_mtime_ns == stat.st_mtime_ns
+        and data.st_size == stat.st_size
+    )
+
+
+def _select_in(
+    db: sqlite3.Connection, query: str, options: str, values: Iterable[str]
+) -> List[Tuple[Any, ...]]:
+    """Return the rows of `query` for the `options`, its `IN ({})` clause
+    being filled with `values` in batches of at most `_BATCH_SIZE`"""
+    values = list(values)
+    rows: List[Tuple[Any, ...]] = []
+    for i in range(0, len(values), _BATCH_SIZE):
+        batch = values[i : i + _BATCH_SIZE]
+        rows.extend(
+            db.execute(
+                query.format(", ".join("?" * len(batch))), (options, *batch)
+            ).fetchall()
+        )
+    return rows
+
+
+def _evict(db: sqlite3.Connection, max_entries: int) -> int:
+    """Delete the least recently used entries beyond `max_entries` in each
+    table, and return how many were deleted"""
+    deleted = 0
+    for table, key in (("digests", "digest"), ("files", "path")):
+        (count,) = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+        if count <= max_entries:
+            continue
+        deleted += db.execute(
+            f"DELETE FROM {table} WHERE (options, {key}) IN ("
+            f" SELECT options, {key} FROM {table}"
+            " ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (max_entries,),
+        ).rowcount
+    return deleted
+
+
+@dataclass
+class CacheStats:
+    path: Path
+    size: int
+    digests: Dict[str, int]
+    files: Dict[str, int]
+
+
+def cache_stats() -> CacheStats:
+    """Return the size of the formatting cache, and how many digests and
+    files it holds for each set of options"""
+    path = get_cache_file()
+    if not path.exists():
+        return CacheStats(path, 0, {}, {})
+    with open_cache_db() as db:
+        digests = db.execute(
+            "SELECT options, COUNT(*) FROM digests GROUP BY options"
+        ).fetchall()
+        files = db.execute(
+            "SELECT options, COUNT(*) FROM files GROUP BY options"
+        ).fetchall()
+    return CacheStats(path, path.stat().st_size, dict(digests), dict(files))
+
+
+def clear_cache() -> None:
+    """Delete the formatting cache"""
+    get_cache_file().unlink(missing_ok=True)
+
+
+def prune_cache(max_entries: int = MAX_CACHE_ENTRIES) -> int:
+    """Delete the entries of files that no longer exist, then the least
+    recently used entries beyond `max_entries`, and compact the database.
+    Returns how many entries were deleted."""
+    if not get_cache_file().exists():
+        return 0
+    with open_cache_db() as db:
+        with db:
+            paths = db.execute("SELECT DISTINCT path FROM files").fetchall()
+            missing = [(path,) for path, in paths if not os.path.exists(path)]
+            changes = db.total_changes
+            db.executemany("DELETE FROM files WHERE path = ?", missing)
+            deleted = db.total_changes - changes + _evict(db, max_entries)
+        db.execute("VACUUM")
+    return deleted
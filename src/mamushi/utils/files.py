@@ -1,5 +1,24 @@
-from typing import Iterator
+"""
+Discovery of the Vyper files to format
+
+Directories are walked with `os.scandir`, whose entries tell files and
+directories apart without a `stat` call on most filesystems. Paths are
+matched against the exclusion regexes and `.gitignore` files as the walk
+goes, so that excluded directories are never entered.
+
+Formatted files are written to a temporary file that replaces them, so that
+they are never seen partially written.
+"""
+import os
+import re
+import stat
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import AnyStr, Iterator, List, Optional, Pattern, Set, Tuple
+
+from pathspec import GitIgnoreSpec
 
 VYPER_EXTENSIONS = {".vy", ".vyi"}
 BLACKLISTED_DIRECTORIES = {
@@ -22,14 +41,230 @@ BLACKLISTED_DIRECTORIES = {
     ".idea",
 }
 
+# walking the top-level directories in parallel mostly helps with slow or
+# cold filesystems, as the threads only run in parallel during system calls
+DISCOVERY_THREADS = 4
+
+# matched against the path of every file and directory relative to the
+# directory being walked, like "/contracts/token.vy" or "/build/"
+DEFAULT_EXCLUDES = (
+    "/("
+    + "|".join(re.escape(name) for name in sorted(BLACKLISTED_DIRECTORIES))
+    + ")/"
+)
+
+# .gitignore files applying to a directory, each with the prefix and the
+# offset turning the path of an entry into one relative to the directory of
+# the .gitignore file: `prefix + path[offset:]`
+Gitignores = List[Tuple[str, int, GitIgnoreSpec]]
+
+
+def find_project_root(path: Path) -> Optional[Path]:
+    """Return the closest directory containing `path` that is the root of
+    a repository, if any"""
+    for directory in [path, *path.parents]:
+        if (directory / ".git").exists() or (directory / ".hg").is_dir():
+            return directory
+    return None
+
+
+def read_gitignore(directory: str) -> Optional[GitIgnoreSpec]:
+    """Return the patterns of the .gitignore file of `directory`, if any"""
+    try:
+        with open(os.path.join(directory, ".gitignore"), encoding="utf8") as f:
+            lines = f.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return None
+    return GitIgnoreSpec.from_lines(lines)
+
+
+def parent_gitignores(path: Path) -> Gitignores:
+    """Return the .gitignore files of the parents of `path` applying to it,
+    up to the root of the repository containing it"""
+    resolved = path.resolve()
+    root = find_project_root(resolved)
+    if root is None or root == resolved:
+        return []
+    offset = len(os.path.join(path, ""))
+    gitignores = []
+    for directory in resolved.parents:
+        spec = read_gitignore(str(directory))
+        if spec is not None:
+            prefix = resolved.relative_to(directory).as_posix() + "/"
+            gitignores.append((prefix, offset, spec))
+        if directory == root:
+            break
+    return gitignores[::-1]
 
-def gen_vyper_files_in_dir(path: Path) -> Iterator[Path]:
-    for child in path.iterdir():
-        if child.is_dir():
-            if child.name in BLACKLISTED_DIRECTORIES:
+
+def is_ignored(path: str, is_dir: bool, gitignores: Gitignores) -> bool:
+    # unlike with git, a negated pattern only re-includes the paths ignored
+    # by the patterns of its own .gitignore file
+    if os.sep != "/":
+        path = path.replace(os.sep, "/")
+    if is_dir:
+        path += "/"
+    return any(
+        spec.match_file(prefix + path[offset:])
+        for prefix, offset, spec in gitignores
+    )
+
+
+class Walker:
+    """
+    Walks directories, yielding each Vyper file that isn't excluded once,
+    even when reached through several symbolic links
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        exclude: Pattern[str],
+        extend_exclude: Optional[Pattern[str]] = None,
+        gitignore: bool = True,
+    ) -> None:
+        # paths are handled as strings, which is much cheaper than `Path`
+        self.offset = len(os.path.join(root, "")) - 1
+        self.excludes = [exclude]
+        if extend_exclude is not None:
+            self.excludes.append(extend_exclude)
+        self.gitignore = gitignore
+        # devices and inodes of the directories and files seen
+        self.seen: Set[Tuple[int, int]] = set()
+        self.lock = threading.Lock()
+
+    def first_seen(self, key: Tuple[int, int]) -> bool:
+        with self.lock:
+            if key in self.seen:
+                return False
+            self.seen.add(key)
+            return True
+
+    def is_excluded(self, path: str, is_dir: bool) -> bool:
+        relative = "/" + path[self.offset + 1 :]
+        if os.sep != "/":
+            relative = relative.replace(os.sep, "/")
+        if is_dir:
+            relative += "/"
+        return any(exclude.search(relative) for exclude in self.excludes)
+
+    def entries(
+        self, directory: str, gitignores: Gitignores, device: int
+    ) -> Iterator[Tuple[str, Optional[Gitignores], int]]:
+        """
+        Yield the Vyper files and the directories to walk in `directory`,
+        in the order of their names, along with the .gitignore files
+        applying to the entries of the directories (None for files) and
+        their device
+        """
+        if self.gitignore:
+            spec = read_gitignore(directory)
+            if spec is not None:
+                offset = len(os.path.join(directory, ""))
+                gitignores = gitignores + [("", offset, spec)]
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                # unlike `stat`, these don't make system calls for the
+                # entries that aren't links, on most filesystems
+                is_dir = entry.is_dir()
+                if not is_dir and (
+                    not entry.is_file()
+                    or os.path.splitext(entry.name)[1] not in VYPER_EXTENSIONS
+                ):
+                    continue
+                path = entry.path
+                if self.is_excluded(path, is_dir) or (
+                    gitignores and is_ignored(path, is_dir, gitignores)
+                ):
+                    continue
+                if is_dir or entry.is_symlink():
+                    st = entry.stat()
+                    key = (st.st_dev, st.st_ino)
+                else:
+                    key = (device, entry.inode())
+            except OSError:
                 continue
+            if self.first_seen(key):
+                yield path, gitignores if is_dir else None, key[0]
+
+    def walk(
+        self, directory: str, gitignores: Gitignores, device: int
+    ) -> Iterator[str]:
+        for path, entry_gitignores, entry_device in self.entries(
+            directory, gitignores, device
+        ):
+            if entry_gitignores is None:
+                yield path
+            else:
+                yield from self.walk(path, entry_gitignores, entry_device)
+
+
+def gen_vyper_files_in_dir(
+    path: Path,
+    exclude: Optional[Pattern[str]] = None,
+    extend_exclude: Optional[Pattern[str]] = None,
+    gitignore: bool = True,
+    threads: int = 1,
+) -> Iterator[Path]:
+    """
+    Yield the Vyper files in `path` and its subdirectories, in the order of
+    their paths, leaving out those matching `exclude` (`DEFAULT_EXCLUDES`
+    by default) or `extend_exclude`, and those ignored by .gitignore files
+    if `gitignore`. The top-level subdirectories are walked by up to
+    `threads` threads at once.
+    """
+    walker = Walker(
+        path,
+        exclude or re.compile(DEFAULT_EXCLUDES),
+        extend_exclude,
+        gitignore,
+    )
+    gitignores = parent_gitignores(path) if gitignore else []
+    st = path.stat()
+    walker.first_seen((st.st_dev, st.st_ino))
+    if threads < 2:
+        for file in walker.walk(str(path), gitignores, st.st_dev):
+            yield Path(file)
+        return
+    with ThreadPoolExecutor(threads) as executor:
+        subtrees = [
+            (entry, None)
+            if entry_gitignores is None
+            else (
+                entry,
+                executor.submit(
+                    list, walker.walk(entry, entry_gitignores, device)
+                ),
+            )
+            for entry, entry_gitignores, device in walker.entries(
+                str(path), gitignores, st.st_dev
+            )
+        ]
+        for entry, subtree in subtrees:
+            for file in [entry] if subtree is None else subtree.result():
+                yield Path(file)
 
-            yield from gen_vyper_files_in_dir(child)
 
-        elif child.suffix in VYPER_EXTENSIONS:
-            yield child
+def write_atomically(path: Path, content: AnyStr) -> None:
+    """
+    Replace the contents of the file at `path` with `content`, written as
+    text if it's a string, keeping its permissions. A symbolic link is left
+    in place, its target being replaced.
+    """
+    target = os.path.realpath(path)
+    mode = stat.S_IMODE(os.stat(target).st_mode)
+    directory, name = os.path.split(target)
+    fd, tmp = tempfile.mkstemp(prefix=f".{name}.", dir=directory)
+    try:
+        with open(fd, "wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+        os.chmod(tmp, mode)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,140 @@
+"""Files and lines changed in a git work tree, for `--changed-since`."""
+import codecs
+import re
+import subprocess
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from mamushi.formatting.ranges import LineRange
+
+# new lines of a hunk of a diff without context, its length being 1 if absent
+_HUNK_HEADER = re.compile(rb"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+
+class GitError(Exception):
+    """Raised when git can't tell what changed."""
+
+
+def run_git(*args: str, cwd: Optional[Path] = None) -> bytes:
+    try:
+        process = subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+    except FileNotFoundError:
+        raise GitError("git is not installed")
+    except subprocess.CalledProcessError as e:
+        message = e.stderr.decode("utf8", "replace").strip()
+        raise GitError(message or f"git {args[0]} failed")
+    return process.stdout
+
+
+def work_tree_root(cwd: Optional[Path] = None) -> Path:
+    return Path(
+        run_git("rev-parse", "--show-toplevel", cwd=cwd).decode("utf8").strip()
+    )
+
+
+def changed_files(rev: str, cwd: Optional[Path] = None) -> Set[Path]:
+    """
+    Return the resolved paths of the files of the work tree that differ
+    from `rev`, whether the changes are staged or not, along with the
+    untracked files that aren't ignored. Deleted files are left out.
+    """
+    root = work_tree_root(cwd)
+    changed = run_git(
+        "diff", "--name-only", "-z", "--diff-filter=d", rev, "--", cwd=root
+    )
+    untracked = run_git(
+        "ls-files", "--others", "--exclude-standard", "-z", cwd=root
+    )
+    return {
+        (root / name.decode("utf8")).resolve()
+        for name in (changed + untracked).split(b"\0")
+        if name
+    }
+
+
+def new_path(header: bytes) -> str:
+    """Return the path of the new version of a file, relative to the root of
+    the work tree, from the `+++ b/<path>` header of its diff"""
+    name = header[4:].rstrip(b"\t")
+    if name.startswith(b'"') and name.endswith(b'"'):
+        # paths with special characters are quoted like C strings
+        name = codecs.escape_decode(name[1:-1])[0]
+    if not name.startswith(b"b/"):
+        raise GitError(
+            "can't read the path of a file in the diff: "
+            + header.decode("utf8", "replace")
+        )
+    return name[2:].decode("utf8")
+
+
+def changed_lines(
+    rev: str, paths: Iterable[Path], cwd: Optional[Path] = None
+) -> Dict[Path, Optional[List[LineRange]]]:
+    """
+    Return the ranges of lines of the given `paths` (resolved) that were
+    added or modified since `rev`, or None for untracked files, which are
+    new as a whole. Files without any such lines are left out.
+    """
+    root = work_tree_root(cwd)
+    wanted = set(paths)
+    diff = run_git(
+        "-c",
+        "core.quotePath=false",
+        "diff",
+        "-U0",
+        "--no-color",
+        "--no-ext-diff",
+        "--diff-filter=d",
+        # whatever the prefixes set in the configuration, like with
+        # `diff.noprefix`
+        "--src-prefix=a/",
+        "--dst-prefix=b/",
+        rev,
+        "--",
+        cwd=root,
+    )
+    line_ranges: Dict[Path, Optional[List[LineRange]]] = {}
+    current: Optional[List[LineRange]] = None
+    # whether the lines are those of the header of the diff of a file,
+    # rather than of its hunks, which may start with `+++ ` too
+    in_header = False
+    for line in diff.splitlines():
+        if line.startswith(b"diff --git "):
+            in_header = True
+            current = None
+            continue
+        if in_header and line.startswith(b"+++ "):
+            path = (root / new_path(line)).resolve()
+            current = [] if path in wanted else None
+            if current is not None:
+                line_ranges[path] = current
+            continue
+        match = _HUNK_HEADER.match(line)
+        if match is None:
+            continue
+        in_header = False
+        if current is None:
+            continue
+        start = int(match.group(1))
+        length = int(match.group(2) or 1)
+        # hunks only removing lines leave none to format
+        if length:
+            current.append((start - 1, start - 1 + length))
+    untracked = run_git(
+        "ls-files", "--others", "--exclude-standard", "-z", cwd=root
+    )
+    for untracked_name in untracked.split(b"\0"):
+        path = (root / untracked_name.decode("utf8")).resolve()
+        if untracked_name and path in wanted:
+            line_ranges[path] = None
+    return {
+        path: ranges
+        for path, ranges in line_ranges.items()
+        if ranges is None or ranges
+    }
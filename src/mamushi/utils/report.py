@@ -45,9 +45,8 @@ class Report:
             if self.verbose:
                 if changed is Changed.NO:
                     msg = f"{src} already well formatted, good job."
-                # TODO: implement with caching
-                # else:
-                #     msg = f"{src} wasn't modified on disk since last run."
+                else:
+                    msg = f"{src} wasn't modified since last run."
                 out(msg, bold=False)
             self.same_count += 1
 
@@ -0,0 +1,95 @@
+"""Choice of the number of worker processes, and of the tasks they get."""
+import math
+import os
+from pathlib import Path
+from typing import List, Optional
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+# below this many bytes in total, starting worker processes, each loading the
+# grammar, costs more than formatting the files in-process
+IN_PROCESS_MAX_BYTES = 64 * 1024
+
+# a worker process is only started for every this many bytes to format
+BYTES_PER_WORKER = 32 * 1024
+
+# files below this size are handed over to workers in batches of up to
+# BATCH_BYTES, as sending them one by one costs about as much as formatting
+SMALL_FILE_BYTES = 4 * 1024
+BATCH_BYTES = 16 * 1024
+
+
+def cgroup_cpu_limit(root: Path = CGROUP_ROOT) -> Optional[float]:
+    """Return the number of CPUs the cgroup quota of the process allows, if
+    it sets one, for both cgroup v2 and v1 hierarchies"""
+    try:
+        quota, period = (root / "cpu.max").read_text().split()[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = (root / "cpu" / "cpu.cfs_quota_us").read_text().strip()
+        period = (root / "cpu" / "cpu.cfs_period_us").read_text().strip()
+        if int(quota) <= 0:
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    """Return the number of CPUs the process may run on, which accounts for
+    its CPU affinity and cgroup quota, unlike `os.cpu_count()`"""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.ceil(limit))
+    return max(cpus, 1)
+
+
+def choose_workers(sizes: List[int], requested: Optional[int] = None) -> int:
+    """
+    Return the number of worker processes to format files of the given
+    `sizes` with, 0 meaning in-process. A `requested` number is used as is,
+    otherwise small batches are formatted in-process, and larger ones by at
+    most one worker per CPU and per `BYTES_PER_WORKER` bytes.
+    """
+    if requested is not None:
+        return requested
+    total = sum(sizes)
+    if len(sizes) < 2 or total < IN_PROCESS_MAX_BYTES:
+        return 0
+    workers = min(
+        available_cpus(), len(sizes), math.ceil(total / BYTES_PER_WORKER)
+    )
+    # a single worker only adds the cost of starting it
+    return workers if workers > 1 else 0
+
+
+def schedule(sizes: List[int]) -> List[List[int]]:
+    """
+    Group the indices of files of the given `sizes` into tasks for the
+    workers, largest files first, so that no worker is left formatting a
+    large file once the others are done. Small files come last, batched.
+    """
+    tasks: List[List[int]] = []
+    batch: List[int] = []
+    batch_size = 0
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        if sizes[i] >= SMALL_FILE_BYTES:
+            tasks.append([i])
+            continue
+        batch.append(i)
+        batch_size += sizes[i]
+        if batch_size >= BATCH_BYTES:
+            tasks.append(batch)
+            batch = []
+            batch_size = 0
+    if batch:
+        tasks.append(batch)
+    return tasks
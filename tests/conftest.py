@@ -1,4 +1,5 @@
 from mamushi.parsing.parser import Parser
+from mamushi.utils import cache
 import pytest
 from click.testing import CliRunner
 
@@ -18,3 +19,12 @@ def runner():
 @pytest.fixture(scope="session")
 def parser():
     return Parser()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def cache_dir(tmp_path_factory):
+    """Keep the caches written by the tests out of the user cache directory"""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        path = tmp_path_factory.mktemp("cache")
+        monkeypatch.setattr(cache, "CACHE_DIR", path)
+        yield path
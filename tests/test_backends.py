@@ -0,0 +1,178 @@
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import mamushi
+from mamushi.utils.backends import (
+    REQUEST_TIMEOUT,
+    HTTPBackend,
+    LocalBackend,
+    entry_key,
+    get_backend,
+)
+from mamushi.utils.report import Changed
+
+from tests.const import MINIMAL_CONTRACT
+
+
+class StoreHandler(BaseHTTPRequestHandler):
+    """Stand-in for a content-addressed store, keeping entries in memory"""
+
+    entries: dict = {}
+
+    def do_GET(self):
+        value = self.entries.get(self.path)
+        if value is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(value)))
+        self.end_headers()
+        self.wfile.write(value)
+
+    def do_PUT(self):
+        length = int(self.headers["Content-Length"])
+        self.entries[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def store():
+    StoreHandler.entries = {}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StoreHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/entries", StoreHandler
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_local_backend(tmp_path):
+    backend = get_backend(str(tmp_path))
+    assert isinstance(backend, LocalBackend)
+    backend.store("ab12", b"value").result()
+    lookups = backend.lookup_many(["ab12", "cd34"])
+    assert lookups["ab12"].result() == b"value"
+    assert lookups["cd34"].result() is None
+    backend.close()
+
+
+def test_http_backend(store):
+    url, handler = store
+    backend = get_backend(url)
+    assert isinstance(backend, HTTPBackend)
+    backend.store("ab12", b"value").result()
+    assert handler.entries == {"/entries/ab12": b"value"}
+    lookups = backend.lookup_many(["ab12", "cd34"])
+    assert lookups["ab12"].result() == b"value"
+    assert lookups["cd34"].result() is None
+    backend.close()
+
+
+def test_unresponsive_backend_not_waited_for(runner, tmp_path):
+    answer = threading.Event()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            answer.wait()
+
+        do_PUT = do_GET
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT.replace("def a():", "def a( ):"))
+    url = f"http://127.0.0.1:{server.server_port}/entries"
+    try:
+        start = time.perf_counter()
+        result = runner.invoke(
+            mamushi.main, ["--cache-backend", url, str(src)]
+        )
+        assert time.perf_counter() - start < REQUEST_TIMEOUT / 2
+    finally:
+        answer.set()
+        server.shutdown()
+        server.server_close()
+    assert result.exit_code == 0
+    assert src.read_text() == MINIMAL_CONTRACT
+
+
+def test_unreachable_backend_misses():
+    backend = HTTPBackend("http://127.0.0.1:9", timeout=1)
+    assert backend.lookup_many(["ab12"])["ab12"].result() is None
+    backend.close()
+
+
+def test_feed_skips_found_outputs(tmp_path):
+    sources = [tmp_path / f"contract_{i}.vy" for i in range(3)]
+    lookups = {source: Future() for source in sources}
+    lookups[sources[0]].set_result(b"output")
+    lookups[sources[1]].set_result(None)
+    # the lookup of the last file is still in flight
+    found = []
+    tasks = [[(sources[0],)], [(sources[1],), (sources[2],)]]
+    fed = list(mamushi.feed(tasks, lookups, found, None))
+    assert fed == [[(sources[1],), (sources[2],)]]
+    assert found == [((sources[0],), b"output")]
+
+
+def test_reuse_output(tmp_path):
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT)
+    output = MINIMAL_CONTRACT.encode("utf8")
+    assert mamushi.reuse_output(src, output, True).changed is Changed.CACHED
+    changed = output.replace(b"pass", b"return")
+    result = mamushi.reuse_output(src, changed, True)
+    assert result.changed is Changed.YES
+    assert src.read_bytes() == changed
+
+
+def test_reuse_output_safe(tmp_path):
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT.replace("def a():", "def a( ):"))
+    for output in [
+        MINIMAL_CONTRACT.replace("pass", "selfdestruct(msg.sender)"),
+        MINIMAL_CONTRACT.replace("def a():", "def a(:"),
+    ]:
+        assert mamushi.reuse_output(src, output.encode(), True, True) is None
+    result = mamushi.reuse_output(src, MINIMAL_CONTRACT.encode(), True, True)
+    assert result.changed is Changed.YES
+    assert src.read_text() == MINIMAL_CONTRACT
+
+
+def test_unsafe_output_formatted_locally(runner, tmp_path):
+    src = tmp_path / "contract.vy"
+    source = MINIMAL_CONTRACT.replace("def a():", "def a( ):")
+    src.write_text(source)
+    planted = MINIMAL_CONTRACT.replace("pass", "selfdestruct(msg.sender)")
+    LocalBackend(tmp_path / "store").put(
+        entry_key(source.encode(), 80, True), planted.encode()
+    )
+    result = runner.invoke(
+        mamushi.main, ["--cache-backend", str(tmp_path / "store"), str(src)]
+    )
+    assert result.exit_code == 0
+    assert src.read_text() == MINIMAL_CONTRACT
+
+
+def test_outputs_shared_through_backend(runner, store, tmp_path):
+    url, handler = store
+    src = tmp_path / "contract.vy"
+    source = MINIMAL_CONTRACT.replace("def a():", "def shared( ):")
+    src.write_text(source)
+    result = runner.invoke(mamushi.main, ["--cache-backend", url, str(src)])
+    assert result.exit_code == 0
+    output = src.read_bytes()
+    assert handler.entries == {
+        f"/entries/{entry_key(source.encode(), 80, True)}": output,
+        f"/entries/{entry_key(output, 80, True)}": output,
+    }
@@ -0,0 +1,201 @@
+import os
+import mamushi
+from mamushi.formatting.format import format_tree
+from mamushi.parsing.parser import Parser
+from mamushi.parsing import registry
+from mamushi.parsing.registry import LALR_OPTIONS
+from mamushi.utils import cache
+
+from tests.const import MINIMAL_CONTRACT
+
+
+def test_grammar_cache_file_is_keyed_by_options(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", tmp_path)
+    grammar = registry.grammar_source()
+    default = cache.grammar_cache_file(grammar, **LALR_OPTIONS)
+    assert default == cache.grammar_cache_file(grammar, **LALR_OPTIONS)
+    assert default != cache.grammar_cache_file(
+        grammar, **dict(LALR_OPTIONS, keep_all_tokens=False)
+    )
+    assert default != cache.grammar_cache_file(grammar + b"\n", **LALR_OPTIONS)
+
+
+def test_parser_reuses_cached_grammar(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", tmp_path)
+    monkeypatch.setattr(registry, "_grammars", {})
+    # compile the grammar instead of loading the pre-generated tables
+    monkeypatch.setattr(registry, "_load_tables", lambda *a, **kw: None)
+    Parser()
+    cached = list(tmp_path.iterdir())
+    assert len(cached) == 1
+    # a grammar loaded back from the cached tables parses just the same
+    registry.reset()
+    tree = Parser().parse(MINIMAL_CONTRACT)
+    assert format_tree(tree) == MINIMAL_CONTRACT
+    assert list(tmp_path.iterdir()) == cached
+
+
+def test_formatting_cache_is_keyed_by_options(tmp_path):
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT)
+    cache.Cache.read(80, True, [src]).write([src])
+    assert cache.Cache.read(80, True, [src]).is_formatted(src)
+    assert not cache.Cache.read(100, True, [src]).is_formatted(src)
+    assert not cache.Cache.read(80, False, [src]).is_formatted(src)
+    src.write_text(MINIMAL_CONTRACT + "\n")
+    assert not cache.Cache.read(80, True, [src]).is_formatted(src)
+
+
+def test_formatting_cache_recovers_from_corrupted_file(tmp_path):
+    cache.get_cache_file().write_bytes(b"not a database" * 100)
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT)
+    assert cache.Cache.read(80, True, [src]).digests == set()
+    cache.Cache.read(80, True, [src]).write([src])
+    assert cache.Cache.read(80, True, [src]).is_formatted(src)
+
+
+def test_check_skips_cached_files(runner, tmp_path):
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT.replace("def a", "def check_skips"))
+    result = runner.invoke(mamushi.main, ["--check", "-v", str(src)])
+    assert "already well formatted" in result.stderr
+    result = runner.invoke(mamushi.main, ["--check", "-v", str(src)])
+    assert result.exit_code == 0
+    assert "wasn't modified since last run" in result.stderr
+    assert "1 file would be left unchanged" in result.stderr
+
+
+def test_reformatted_files_are_cached(runner, tmp_path):
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT.replace("def a():", "def a( ):"))
+    result = runner.invoke(mamushi.main, [str(src)])
+    assert "reformatted" in result.stderr
+    assert src.read_text() == MINIMAL_CONTRACT
+    result = runner.invoke(mamushi.main, ["--check", "-v", str(src)])
+    assert "wasn't modified since last run" in result.stderr
+
+
+def test_formatting_cache_checks_stat_before_hashing(tmp_path, monkeypatch):
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT)
+    cache.Cache.read(80, True, [src]).write([src])
+
+    def hash_digest(path):
+        raise AssertionError(f"{path} was hashed")
+
+    with monkeypatch.context() as m:
+        m.setattr(cache, "hash_digest", hash_digest)
+        assert cache.Cache.read(80, True, [src]).is_formatted(src)
+
+    # a file touched without being changed is recognized by its hash
+    stat = src.stat()
+    os.utime(src, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.Cache.read(80, True, [src]).is_formatted(src)
+    src.write_text(MINIMAL_CONTRACT.replace("a", "b"))
+    assert not cache.Cache.read(80, True, [src]).is_formatted(src)
+
+
+def test_formatting_cache_reads_given_sources(tmp_path):
+    sources = []
+    for i in range(2):
+        src = tmp_path / f"contract_{i}.vy"
+        src.write_text(MINIMAL_CONTRACT.replace("def a", f"def read_{i}"))
+        sources.append(src)
+    cache.Cache.read(80, True, sources).write(sources)
+    formatted = cache.Cache.read(80, True, sources[:1])
+    assert list(formatted.files) == [os.path.abspath(sources[0])]
+    # contents are only looked up for the files whose stat data changed
+    assert formatted.digests == set()
+    stat = sources[0].stat()
+    os.utime(sources[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    formatted = cache.Cache.read(80, True, sources[:1])
+    assert formatted.digests == {cache.hash_digest(sources[0])}
+
+
+def test_formatting_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "MAX_CACHE_ENTRIES", 3)
+    cache.clear_cache()
+    sources = []
+    for i in range(5):
+        src = tmp_path / f"contract_{i}.vy"
+        src.write_text(MINIMAL_CONTRACT.replace("def a", f"def lru_{i}"))
+        sources.append(src)
+        cache.Cache.read(80, True, [sources[0], src]).write([sources[0], src])
+    stats = cache.cache_stats()
+    assert stats.digests == {"80.1": 3} and stats.files == {"80.1": 3}
+    formatted = cache.Cache.read(80, True, sources)
+    # the first file was used by every write
+    assert [formatted.is_formatted(src) for src in sources] == [
+        True,
+        False,
+        False,
+        True,
+        True,
+    ]
+
+
+def test_prune_cache(tmp_path):
+    cache.clear_cache()
+    sources = []
+    for i in range(4):
+        src = tmp_path / f"contract_{i}.vy"
+        src.write_text(MINIMAL_CONTRACT.replace("def a", f"def prune_{i}"))
+        sources.append(src)
+    cache.Cache.read(80, True, sources).write(sources)
+    sources[0].unlink()
+    assert cache.prune_cache(max_entries=2) == 1 + 2 + 1
+    stats = cache.cache_stats()
+    assert stats.digests == {"80.1": 2} and stats.files == {"80.1": 2}
+
+
+def test_cache_commands(runner, tmp_path):
+    src = tmp_path / "contract.vy"
+    src.write_text(MINIMAL_CONTRACT)
+    runner.invoke(mamushi.main, ["--check", str(src)])
+    result = runner.invoke(mamushi.main, ["cache", "stats"])
+    assert result.exit_code == 0
+    assert "line length 80, safe True" in result.stdout
+    result = runner.invoke(mamushi.main, ["cache", "prune"])
+    assert result.exit_code == 0
+    result = runner.invoke(mamushi.main, ["cache", "clear"])
+    assert result.exit_code == 0
+    assert not cache.get_cache_file().exists()
+    assert cache.cache_stats().digests == {}
+
+
+def test_cache_directory_is_formatted(runner, tmp_path, monkeypatch):
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "contract.vy").write_text(MINIMAL_CONTRACT)
+    monkeypatch.chdir(tmp_path)
+    result = runner.invoke(mamushi.main, ["--check", "cache"])
+    assert result.exit_code == 0
+    assert "1 file would be left unchanged" in result.stderr
+
+
+def test_cache_command_shadowing_path(runner, tmp_path, monkeypatch):
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "contract.vy").write_text(MINIMAL_CONTRACT)
+    (tmp_path / "stats").mkdir()
+    monkeypatch.chdir(tmp_path)
+    # the command runs rather than the formatting of the paths
+    result = runner.invoke(mamushi.main, ["cache", "stats"])
+    assert result.exit_code == 0
+    assert "use ./cache to format the path cache" in result.stderr
+    assert "location:" in result.stdout
+    for args in [["./cache"], ["--", "cache"]]:
+        result = runner.invoke(mamushi.main, ["--check", *args])
+        assert result.exit_code == 0
+        assert "1 file would be left unchanged" in result.stderr
+
+
+def test_subcommands_help(runner):
+    result = runner.invoke(mamushi.main, ["--help"], prog_name="mamushi")
+    assert result.exit_code == 0
+    commands = result.stdout.split("Commands:\n", 1)[1].split()
+    assert commands[0] == "cache" and "lsp" in commands
+    result = runner.invoke(
+        mamushi.main, ["cache", "stats", "--help"], prog_name="mamushi"
+    )
+    assert result.exit_code == 0
+    assert result.stdout.startswith("Usage: mamushi cache stats [OPTIONS]")
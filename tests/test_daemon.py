@@ -0,0 +1,164 @@
+import http.client
+import socket
+import threading
+
+import pytest
+from click.testing import CliRunner
+
+from mamushi import daemon
+from mamushi.daemon import Formatter, make_server
+
+from tests.const import MINIMAL_CONTRACT
+
+UNFORMATTED = MINIMAL_CONTRACT.replace("def", "def  ")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str) -> None:
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+@pytest.fixture(scope="module")
+def formatter():
+    formatter = Formatter(workers=1, max_requests=2, timeout=10)
+    yield formatter
+    formatter.close()
+
+
+@pytest.fixture
+def server(formatter):
+    server = make_server(formatter, port=0)
+    thread = threading.Thread(
+        target=server.serve_forever, args=(0.05,), daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(connection, source: str, **headers: str):
+    connection.request(
+        "POST", "/", body=source.encode("utf8"), headers=headers
+    )
+    response = connection.getresponse()
+    return response.status, response.read().decode("utf8")
+
+
+@pytest.fixture
+def connection(server):
+    host, port = server.server_address[:2]
+    connection = http.client.HTTPConnection(host, port, timeout=10)
+    yield connection
+    connection.close()
+
+
+def test_format(connection):
+    assert post(connection, UNFORMATTED) == (200, MINIMAL_CONTRACT)
+    assert post(connection, MINIMAL_CONTRACT) == (204, "")
+    # the connection is kept alive, and the output cached
+    assert post(connection, UNFORMATTED) == (200, MINIMAL_CONTRACT)
+
+
+def test_format_options(connection):
+    assert post(connection, UNFORMATTED, **{"X-Check": "true"}) == (200, "")
+    status, body = post(connection, UNFORMATTED, **{"X-Diff": "1"})
+    assert status == 200
+    assert body.splitlines()[0].startswith("--- In")
+    source = UNFORMATTED.replace("pass", "return 1 + 2 + 3 + 4")
+    status, body = post(
+        connection, source, **{"X-Line-Length": "20", "X-Safe": "false"}
+    )
+    assert status == 200
+    assert body.splitlines()[2:4] == ["    return (", "        1"]
+
+
+@pytest.mark.parametrize(
+    "source,headers,message",
+    [
+        (UNFORMATTED, {"X-Line-Length": "x"}, "invalid literal"),
+        (UNFORMATTED, {"X-Check": "maybe"}, "invalid boolean"),
+        ("def f(:\n", {}, "Unable to parse"),
+    ],
+)
+def test_bad_request(connection, source, headers, message):
+    status, body = post(connection, source, **headers)
+    assert status == 400
+    assert message in body
+
+
+def test_busy(formatter, connection):
+    for _ in range(2):
+        formatter.slots.acquire()
+    try:
+        status, _ = post(connection, UNFORMATTED + "\n# busy\n")
+    finally:
+        for _ in range(2):
+            formatter.slots.release()
+    assert status == 503
+
+
+def test_timeout(formatter, connection, monkeypatch):
+    monkeypatch.setattr(formatter, "timeout", 0.01)
+    source = "".join(UNFORMATTED.replace("a()", f"f{i}()") for i in range(300))
+    status, body = post(connection, source)
+    assert (status, body) == (504, "Formatting timed out")
+
+
+def test_negative_content_length(connection):
+    connection.putrequest("POST", "/")
+    connection.putheader("Content-Length", "-1")
+    connection.endheaders()
+    response = connection.getresponse()
+    assert response.status == 400
+    assert "Content-Length" in response.read().decode("utf8")
+
+
+def test_body_timeout(formatter, server, monkeypatch):
+    monkeypatch.setattr(server.RequestHandlerClass, "timeout", 0.05)
+    with socket.create_connection(server.server_address[:2]) as sock:
+        sock.sendall(b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nx")
+        response = sock.makefile("rb").read()
+    assert response.startswith(b"HTTP/1.1 504 ")
+    assert response.endswith(b"Reading the body timed out")
+
+
+def test_unix_socket(formatter, tmp_path):
+    path = tmp_path / "mamushid.sock"
+    server = make_server(formatter, socket_path=path)
+    thread = threading.Thread(
+        target=server.serve_forever, args=(0.05,), daemon=True
+    )
+    thread.start()
+    try:
+        connection = UnixHTTPConnection(str(path))
+        assert post(connection, UNFORMATTED) == (200, MINIMAL_CONTRACT)
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_socket_path_not_a_socket(formatter, tmp_path):
+    path = tmp_path / "contract.vy"
+    path.write_text(MINIMAL_CONTRACT)
+    with pytest.raises(FileExistsError):
+        make_server(formatter, socket_path=path)
+    result = CliRunner().invoke(
+        daemon.main, ["--workers", "1", "--socket", str(path)]
+    )
+    assert result.exit_code == 2
+    assert "isn't a socket" in result.output
+    assert path.read_text() == MINIMAL_CONTRACT
+
+
+def test_stale_socket_replaced(formatter, tmp_path):
+    path = tmp_path / "mamushid.sock"
+    make_server(formatter, socket_path=path).server_close()
+    assert path.is_socket()
+    make_server(formatter, socket_path=path).server_close()
@@ -1,6 +1,10 @@
 from tests.reader import all_data_cases, read_data, all_data
 import pytest
 from mamushi.formatting.format import format_tree
+from mamushi.formatting.linegen import LineGenerator
+from mamushi.formatting.lines import is_line_final, split_line
+from mamushi.formatting.ranges import format_line_ranges, split_lines
+from mamushi.parsing.comparator import find_ast_change
 
 test_cases = [
     (category, case)
@@ -13,3 +17,101 @@ test_cases = [
 def test_format(case: str, category: str, parser):
     source, expected = read_data(category, case)
     assert format_tree(parser.parse(source)).strip() == expected.strip()
+
+
+@pytest.mark.parametrize("category,case", test_cases)
+def test_final_lines_are_not_split(case: str, category: str, parser):
+    source, _ = read_data(category, case)
+    for line in LineGenerator(80).visit(parser.parse(source)):
+        if is_line_final(line, 80):
+            assert list(split_line(line, line_length=80)) == [line]
+
+
+@pytest.mark.parametrize("category,case", test_cases)
+def test_format_all_line_ranges(case: str, category: str, parser):
+    source, _ = read_data(category, case)
+    expected = format_tree(parser.parse(source))
+    line_ranges = [(0, len(split_lines(source)))]
+    assert (
+        format_line_ranges(parser.parse(source), source, line_ranges)
+        == expected
+    )
+
+
+@pytest.mark.parametrize("category,case", test_cases)
+def test_format_each_line(case: str, category: str, parser):
+    source, _ = read_data(category, case)
+    try:
+        unsafe = (
+            find_ast_change(source, format_tree(parser.parse(source)))
+            is not None
+        )
+    except Exception:
+        unsafe = True
+    if unsafe:
+        pytest.skip("formatting the whole file breaks it already")
+    for line in range(len(split_lines(source))):
+        result = format_line_ranges(
+            parser.parse(source), source, [(line, line + 1)]
+        )
+        assert find_ast_change(source, result) is None, f"line {line + 1}"
+
+
+LINE_RANGES_SOURCE = """x: uint256  # c
+y:   uint256
+# standalone
+@external
+def f(
+    a: uint256, b: uint256
+) -> uint256:
+    if a: return 1+1
+    z: uint256 = 1+2
+    return foo(a,
+        b)
+"""
+
+
+@pytest.mark.parametrize(
+    "line_ranges,old,new",
+    [
+        ([(1, 2)], "y:   uint256", "y: uint256"),
+        ([(7, 8)], "    if a: return 1+1", "    if a:\n        return 1 + 1"),
+        (
+            [(8, 9), (9, 10)],
+            "1+2\n    return foo(a,\n        b)",
+            "1 + 2\n    return foo(a, b)",
+        ),
+        (
+            [(4, 5)],
+            "def f(\n    a: uint256, b: uint256\n) ->",
+            "def f(a: uint256, b: uint256) ->",
+        ),
+    ],
+)
+def test_format_line_ranges(line_ranges, old, new, parser):
+    result = format_line_ranges(
+        parser.parse(LINE_RANGES_SOURCE), LINE_RANGES_SOURCE, line_ranges
+    )
+    assert result == LINE_RANGES_SOURCE.replace(old, new)
+
+
+OVER_INDENTED = """x: uint256
+
+
+@external
+def f():
+        a: uint256 = 1+1
+        if a:
+                b: uint256 = 2
+"""
+
+
+@pytest.mark.parametrize("line_range", [(5, 6), (7, 8)])
+def test_format_line_ranges_reindents_blocks(line_range, parser):
+    # the whole function is re-indented, not just the lines of the range
+    result = format_line_ranges(
+        parser.parse(OVER_INDENTED), OVER_INDENTED, [line_range]
+    )
+    assert result == OVER_INDENTED.replace("1+1", "1 + 1").replace(
+        "        ", "    "
+    )
@@ -0,0 +1,119 @@
+import subprocess
+
+import pytest
+
+import mamushi
+from mamushi.utils.git import GitError, changed_files, changed_lines
+
+from tests.const import MINIMAL_CONTRACT
+
+UNFORMATTED = MINIMAL_CONTRACT.replace("def", "def  ")
+
+
+def git(repo, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@test", *args],
+        cwd=repo,
+        check=True,
+        capture_output=True,
+    )
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """A repository with a committed file, a modified one, a staged one and
+    an untracked one"""
+    git(tmp_path, "init", "-q")
+    for name in ["committed", "modified", "staged"]:
+        (tmp_path / f"{name}.vy").write_text(
+            UNFORMATTED + "\n\n" + UNFORMATTED
+        )
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "initial")
+    (tmp_path / "modified.vy").write_text(
+        UNFORMATTED + "\n\n" + UNFORMATTED.replace("a()", "b()")
+    )
+    (tmp_path / "staged.vy").write_text(UNFORMATTED)
+    git(tmp_path, "add", "staged.vy")
+    (tmp_path / "untracked.vy").write_text(UNFORMATTED)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path.resolve()
+
+
+def test_changed_files(repo):
+    assert changed_files("HEAD") == {
+        repo / name for name in ["modified.vy", "staged.vy", "untracked.vy"]
+    }
+
+
+def test_changed_lines(repo):
+    paths = [repo / name for name in ["committed.vy", "modified.vy"]]
+    paths.append(repo / "untracked.vy")
+    assert changed_lines("HEAD", paths) == {
+        repo / "modified.vy": [(6, 7)],
+        repo / "untracked.vy": None,
+    }
+
+
+@pytest.mark.parametrize(
+    "config", [["diff.noprefix", "true"], ["diff.mnemonicPrefix", "true"]]
+)
+def test_changed_lines_prefixes(repo, config):
+    git(repo, "config", *config)
+    assert changed_lines("HEAD", [repo / "modified.vy"]) == {
+        repo / "modified.vy": [(6, 7)]
+    }
+
+
+def test_changed_lines_quoted_path(repo):
+    path = repo / 'quote"d.vy'
+    path.write_text(UNFORMATTED)
+    git(repo, "add", path.name)
+    git(repo, "commit", "-q", "-m", "quoted")
+    # an added line starting with `++ ` isn't taken for a header
+    path.write_text(UNFORMATTED + "++ x\n")
+    assert changed_lines("HEAD", [path]) == {path: [(3, 4)]}
+
+
+def test_unknown_revision(repo):
+    with pytest.raises(GitError):
+        changed_files("no-such-revision")
+
+
+def test_changed_since(runner, repo):
+    result = runner.invoke(mamushi.main, ["--changed-since", "HEAD"])
+    assert result.exit_code == 0
+    assert (repo / "committed.vy").read_text() == UNFORMATTED + "\n\n" + (
+        UNFORMATTED
+    )
+    for name in ["staged.vy", "untracked.vy"]:
+        assert (repo / name).read_text() == MINIMAL_CONTRACT
+    # only the changed function is formatted
+    assert (repo / "modified.vy").read_text() == (
+        MINIMAL_CONTRACT + "\n\n" + MINIMAL_CONTRACT.replace("a()", "b()")
+    )
+
+
+def test_changed_lines_cli(runner, repo):
+    result = runner.invoke(
+        mamushi.main, ["--changed-since", "HEAD", "--changed-lines"]
+    )
+    assert result.exit_code == 0
+    assert (repo / "modified.vy").read_text() == (
+        UNFORMATTED + "\n\n" + MINIMAL_CONTRACT.replace("a()", "b()")
+    )
+    assert (repo / "staged.vy").read_text() == UNFORMATTED
+    assert (repo / "untracked.vy").read_text() == MINIMAL_CONTRACT
+
+
+@pytest.mark.parametrize(
+    "args,message",
+    [
+        (["--changed-since", "no-such-revision"], "--changed-since:"),
+        (["--changed-lines"], "only be used with --changed-since"),
+    ],
+)
+def test_changed_since_errors(runner, repo, args, message):
+    result = runner.invoke(mamushi.main, args)
+    assert result.exit_code == 2
+    assert message in result.stderr
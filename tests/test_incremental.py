@@ -0,0 +1,111 @@
+import pytest
+from lark.exceptions import LarkError
+
+from mamushi.formatting.format import format_tree
+from mamushi.formatting.incremental import IncrementalFormatter, split_units
+from mamushi.formatting.parallel import format_in_parallel, make_chunks
+from tests.reader import all_data, all_data_cases, read_data
+
+test_cases = [
+    (category, case)
+    for category in all_data()
+    for case in all_data_cases(category)
+]
+
+CONTRACT = """# @version 0.3.7
+\"\"\"
+@title test
+\"\"\"
+owner: public(address)
+total: uint256
+
+
+struct Point:
+    x: uint256
+    y: uint256
+@external
+@view
+def get(a: uint256) -> uint256:
+    return self.total + a
+# trailing comment
+
+@internal
+def _set(
+    a: uint256,
+    b: uint256,  # b
+):
+    self.total = a + b
+"""
+
+
+def test_split_units():
+    units = split_units(CONTRACT)
+    assert "".join(units) == CONTRACT
+    assert [unit.split("\n")[0] for unit in units] == [
+        "# @version 0.3.7",
+        "owner: public(address)",
+        "total: uint256",
+        "struct Point:",
+        "@external",
+        "@internal",
+    ]
+
+
+@pytest.mark.parametrize("category,case", test_cases)
+def test_incremental_format(case: str, category: str, parser):
+    source, _ = read_data(category, case)
+    expected = format_tree(parser.parse(source))
+    formatter = IncrementalFormatter(parser=parser)
+    assert formatter.format(source) == expected
+    assert formatter.format(source) == expected
+    assert formatter.formatted == 0
+
+
+@pytest.mark.parametrize(
+    "old,new",
+    [
+        ("return self.total + a", "return self.total+a*2"),
+        ("total: uint256\n", "total: uint256\n\n\n\n"),
+        ("# trailing comment\n", ""),
+        ("@external\n@view\n", "@view\n"),
+        ("    b: uint256,  # b\n", ""),
+    ],
+)
+def test_incremental_edit(old: str, new: str, parser):
+    formatter = IncrementalFormatter(parser=parser)
+    formatter.format(CONTRACT)
+    source = CONTRACT.replace(old, new)
+    assert formatter.format(source) == format_tree(parser.parse(source))
+    assert formatter.formatted == 1
+    assert formatter.reused == len(split_units(source)) - 1
+
+
+def test_incremental_syntax_error(parser):
+    formatter = IncrementalFormatter(parser=parser)
+    with pytest.raises(LarkError):
+        formatter.format(CONTRACT.replace("struct Point:", "struct Point"))
+
+
+def test_make_chunks():
+    units = split_units(CONTRACT)
+    chunks = make_chunks(units, 3)
+    assert len(chunks) <= 3
+    assert [text for chunk in chunks for text, _ in chunk] == units
+    assert [last for chunk in chunks for _, last in chunk] == [False] * (
+        len(units) - 1
+    ) + [True]
+
+
+def test_format_in_parallel(parser):
+    source = "".join(
+        read_data("modules", case)[0] for case in all_data_cases("modules")
+    )
+    expected = format_tree(parser.parse(source))
+    assert format_in_parallel(source, processes=2) == expected
+
+
+def test_format_in_parallel_syntax_error():
+    with pytest.raises(LarkError):
+        format_in_parallel(
+            CONTRACT.replace("struct Point:", "struct Point"), processes=2
+        )
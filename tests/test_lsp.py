@@ -0,0 +1,230 @@
+import io
+import json
+
+import pytest
+
+from mamushi import lsp
+from mamushi.formatting.ranges import (
+    Hunk,
+    apply_hunks,
+    diff_hunks,
+    split_lines,
+)
+from mamushi.lsp import (
+    METHOD_NOT_FOUND,
+    REQUEST_FAILED,
+    Document,
+    LanguageServer,
+    to_character,
+    to_index,
+)
+
+URI = "file:///contract.vy"
+
+UNFORMATTED = """@external
+def  a():
+    x: uint256 = 1+2
+    y: uint256 = 3+4
+    z: uint256 = 5+6
+"""
+
+
+def message(method, params=None, id=None):
+    content = {"jsonrpc": "2.0", "method": method}
+    if params is not None:
+        content["params"] = params
+    if id is not None:
+        content["id"] = id
+    body = json.dumps(content).encode("utf8")
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+
+def run(*messages):
+    """Run a server over `messages`, returning its exit code and responses"""
+    writer = io.BytesIO()
+    server = LanguageServer(io.BytesIO(b"".join(messages)), writer)
+    code = server.serve()
+    responses = []
+    output = writer.getvalue()
+    while output:
+        header, _, output = output.partition(b"\r\n\r\n")
+        length = int(header.split(b":")[1])
+        responses.append(json.loads(output[:length]))
+        output = output[length:]
+    return code, {response["id"]: response for response in responses}
+
+
+def open_document(text=UNFORMATTED):
+    return message(
+        "textDocument/didOpen",
+        {
+            "textDocument": {
+                "uri": URI,
+                "languageId": "vyper",
+                "version": 1,
+                "text": text,
+            }
+        },
+    )
+
+
+def apply_edits(text, edits):
+    document = Document(text, 0)
+    for edit in reversed(edits):
+        document.apply_change(
+            {"range": edit["range"], "text": edit["newText"]}
+        )
+    return document.text
+
+
+def test_format_document():
+    code, responses = run(
+        message("initialize", {"capabilities": {}}, id=1),
+        message("initialized", {}),
+        open_document(),
+        message(
+            "textDocument/formatting", {"textDocument": {"uri": URI}}, id=2
+        ),
+        message("shutdown", id=3),
+        message("exit"),
+    )
+    assert code == 0
+    capabilities = responses[1]["result"]["capabilities"]
+    assert capabilities["documentRangeFormattingProvider"]
+    assert apply_edits(UNFORMATTED, responses[2]["result"]) == (
+        UNFORMATTED.replace("def  a", "def a")
+        .replace("1+2", "1 + 2")
+        .replace("3+4", "3 + 4")
+        .replace("5+6", "5 + 6")
+    )
+    assert responses[3]["result"] is None
+
+
+def test_format_range():
+    _, responses = run(
+        open_document(),
+        message(
+            "textDocument/rangeFormatting",
+            {
+                "textDocument": {"uri": URI},
+                "range": {
+                    "start": {"line": 3, "character": 0},
+                    "end": {"line": 4, "character": 0},
+                },
+            },
+            id=1,
+        ),
+    )
+    edits = responses[1]["result"]
+    assert apply_edits(UNFORMATTED, edits) == UNFORMATTED.replace(
+        "3+4", "3 + 4"
+    )
+
+
+def test_incremental_changes():
+    _, responses = run(
+        open_document(),
+        message(
+            "textDocument/didChange",
+            {
+                "textDocument": {"uri": URI, "version": 2},
+                "contentChanges": [
+                    {
+                        "range": {
+                            "start": {"line": 2, "character": 17},
+                            "end": {"line": 4, "character": 20},
+                        },
+                        "text": "1 + 2",
+                    },
+                    {
+                        "range": {
+                            "start": {"line": 1, "character": 3},
+                            "end": {"line": 1, "character": 5},
+                        },
+                        "text": " ",
+                    },
+                ],
+            },
+        ),
+        message(
+            "textDocument/formatting", {"textDocument": {"uri": URI}}, id=1
+        ),
+    )
+    assert responses[1]["result"] == []
+
+
+def test_errors():
+    code, responses = run(
+        open_document("def f(:\n"),
+        message(
+            "textDocument/formatting", {"textDocument": {"uri": URI}}, id=1
+        ),
+        message("textDocument/hover", {}, id=2),
+    )
+    # the input ended without a shutdown request
+    assert code == 1
+    assert responses[1]["error"]["code"] == REQUEST_FAILED
+    assert responses[2]["error"]["code"] == METHOD_NOT_FOUND
+
+
+@pytest.mark.parametrize(
+    "line,index,character",
+    [("abc\n", 2, 2), ("é𝄞x\n", 2, 3), ("é𝄞x\n", 3, 4)],
+)
+def test_utf16_positions(line, index, character):
+    assert to_character(line, index) == character
+    assert to_index(line, character) == index
+
+
+def test_hunks():
+    src = split_lines("a\nb\nc\n")
+    dst = split_lines("A\nb\nC\nD\n")
+    assert split_lines("a\r\nb\rc") == ["a\r\n", "b\r", "c"]
+    hunks = diff_hunks(src, dst)
+    assert hunks == [Hunk(0, 1, ["A\n"]), Hunk(2, 3, ["C\n", "D\n"])]
+    assert apply_hunks(src, hunks) == "A\nb\nC\nD\n"
+    assert apply_hunks(src, hunks[1:]) == "a\nb\nC\nD\n"
+
+
+OVER_INDENTED = """@external
+def f():
+        a: uint256 = 1+1
+        b: uint256 = 2
+"""
+
+
+def format_range(line, text=OVER_INDENTED):
+    _, responses = run(
+        open_document(text),
+        message(
+            "textDocument/rangeFormatting",
+            {
+                "textDocument": {"uri": URI},
+                "range": {
+                    "start": {"line": line, "character": 0},
+                    "end": {"line": line + 1, "character": 0},
+                },
+            },
+            id=1,
+        ),
+    )
+    return responses[1]
+
+
+def test_format_range_reindents_block():
+    edits = format_range(2)["result"]
+    assert apply_edits(OVER_INDENTED, edits) == (
+        OVER_INDENTED.replace("        ", "    ").replace("1+1", "1 + 1")
+    )
+
+
+def test_format_range_checks_edited_code(monkeypatch):
+    # the code the edits give is checked, not the formatted document
+    monkeypatch.setattr(
+        lsp,
+        "format_line_ranges",
+        lambda ast, src, line_ranges, line_length: src.replace(
+            "        b", "    b"
+        ),
+    )
+    assert format_range(3)["error"]["code"] == REQUEST_FAILED
@@ -1,6 +1,8 @@
+import multiprocessing
 import os
 from pathlib import Path
 
+import click
 import pytest
 import mamushi
 from mamushi.utils.output import dump_to_file
@@ -98,6 +100,136 @@ def test_check_multiple_files(runner):
     assert "files would be reformatted" in result.stderr
 
 
+def test_parallel_threshold(runner):
+    source, expected = read_data("modules", "modules_blank_lines.vy")
+    tmp_file = Path(dump_to_file(source))
+    try:
+        result = runner.invoke(
+            mamushi.main, ["--parallel-threshold", 1, str(tmp_file)]
+        )
+        assert result.exit_code == 0
+        with open(str(tmp_file), "r") as fp:
+            assert fp.read().strip() == expected.strip()
+    finally:
+        os.unlink(tmp_file)
+
+
+@pytest.mark.parametrize("workers", ["0", "2"])
+def test_workers(runner, workers):
+    result = runner.invoke(
+        mamushi.main,
+        ["--workers", workers, "--check", str(DATA_DIR / "imports")],
+    )
+    assert result.exit_code == 1
+    assert "files would be reformatted" in result.stderr
+
+
+def test_exclude(runner, tmp_path):
+    (tmp_path / "vendor").mkdir()
+    for path in ["a.vy", "vendor/b.vy"]:
+        (tmp_path / path).write_text(MINIMAL_CONTRACT.replace("def", "def  "))
+    result = runner.invoke(
+        mamushi.main,
+        ["--check", "--extend-exclude", "/vendor/", str(tmp_path)],
+    )
+    assert result.exit_code == 1
+    assert "1 file would be reformatted" in result.stderr
+    result = runner.invoke(mamushi.main, ["--exclude", "(", str(tmp_path)])
+    assert result.exit_code == 2
+    assert "not a valid regex" in result.stderr
+
+
+def test_unchanged_files_not_written(runner, tmp_path):
+    formatted = tmp_path / "formatted.vy"
+    formatted.write_text(MINIMAL_CONTRACT)
+    unformatted = tmp_path / "unformatted.vy"
+    unformatted.write_text(MINIMAL_CONTRACT.replace("def", "def  "))
+    for path in [formatted, unformatted]:
+        os.utime(path, (0, 0))
+    result = runner.invoke(mamushi.main, ["--workers", "0", str(tmp_path)])
+    assert result.exit_code == 0
+    assert formatted.stat().st_mtime == 0
+    assert unformatted.stat().st_mtime > 0
+    assert unformatted.read_text() == MINIMAL_CONTRACT
+
+
+def test_in_order():
+    sources = [Path(f"{i}.vy") for i in range(5)]
+    results = [
+        mamushi.ProcessResult(src=sources[i], success=True)
+        for i in [2, 0, 4, 1, 3]
+    ]
+    seen = []
+
+    def stream():
+        for result in results:
+            seen.append(result.src)
+            yield result
+
+    ordered = mamushi.in_order(stream(), sources)
+    assert next(ordered).src == sources[0]
+    # results are yielded as soon as the ones before them are
+    assert seen == sources[2::-2]
+    assert [result.src for result in ordered] == sources[1:]
+
+
+def test_diff_multiple_files_in_order(runner):
+    sources = list(mamushi.gen_vyper_files_in_dir(DATA_DIR / "imports"))
+    result = runner.invoke(
+        mamushi.main, ["--workers", "2", "--diff", *map(str, sources)]
+    )
+    assert result.exit_code == 0
+    names = [
+        line.rsplit(" - ", 1)[1]
+        for line in click.unstyle(result.stdout).splitlines()
+        if line.startswith("+++")
+    ]
+    assert names == [str(source) for source in sources]
+
+
+@pytest.mark.parametrize("given", [["contract.vy"], ["."]])
+def test_duplicated_source(runner, tmp_path, monkeypatch, given):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "contract.vy").write_text(
+        MINIMAL_CONTRACT.replace("def a", "def  a")
+    )
+    result = runner.invoke(mamushi.main, ["--check", *given, "contract.vy"])
+    assert result.exit_code == 1
+    assert result.stderr.count("would reformat contract.vy") == 1
+    assert "1 file would be reformatted" in result.stderr
+
+
+def test_line_ranges(runner, tmp_path):
+    source = MINIMAL_CONTRACT + "\n\n@external\ndef  b():\n    pass\n"
+    tmp_file = tmp_path / "contract.vy"
+    tmp_file.write_text(source.replace("def a", "def  a"))
+    result = runner.invoke(
+        mamushi.main, ["--line-ranges", "6-7", str(tmp_file)]
+    )
+    assert result.exit_code == 0
+    assert tmp_file.read_text() == source.replace("def a", "def  a").replace(
+        "def  b", "def b"
+    )
+
+
+@pytest.mark.parametrize(
+    "line_ranges,message",
+    [
+        (["2"], "is not of the form START-END"),
+        (["3-2"], "ends before it starts"),
+        (["1-2", "--check", str(DATA_DIR / "imports")], "a single file"),
+    ],
+)
+def test_invalid_line_ranges(runner, tmp_path, line_ranges, message):
+    tmp_file = tmp_path / "contract.vy"
+    tmp_file.write_text(MINIMAL_CONTRACT)
+    result = runner.invoke(
+        mamushi.main, ["--line-ranges", *line_ranges, str(tmp_file)]
+    )
+    assert result.exit_code == 2
+    assert message in result.stderr
+
+
 def test_invalid_file(runner):
     result = runner.invoke(mamushi.main, ["--check", "AAAAAAAAAAAAAAAA.x"])
     assert result.exit_code == 2
@@ -137,3 +269,36 @@ def test_output_to_console(runner):
         ), "File was modified despite --in-place = False"
     finally:
         os.unlink(tmp_file)
+
+
+def test_check_unchanged_file_skips_ast_comparison(monkeypatch, parser):
+    def find_ast_change(*args, **kwargs):
+        raise AssertionError("an unchanged file was compared")
+
+    monkeypatch.setattr(mamushi, "find_ast_change", find_ast_change)
+    tmp_file = Path(dump_to_file(MINIMAL_CONTRACT))
+    try:
+        result = mamushi.reformat(
+            src=tmp_file,
+            parser=parser,
+            safe=True,
+            diff=False,
+            in_place=False,
+            check=True,
+            line_length=80,
+        )
+        assert result.success
+        assert result.changed is mamushi.Changed.NO
+    finally:
+        os.unlink(tmp_file)
+
+
+def _worker_parser_id(_):
+    return os.getpid(), id(mamushi._worker_parser)
+
+
+def test_worker_parser_built_once():
+    with multiprocessing.Pool(2, initializer=mamushi.init_worker) as pool:
+        ids = pool.map(_worker_parser_id, range(8))
+    assert all(parser_id != id(None) for _, parser_id in ids)
+    assert len(set(ids)) == len({pid for pid, _ in ids})
@@ -1,5 +1,21 @@
+import json
+import multiprocessing
+import os
+import sys
+import textwrap
+from collections import defaultdict
+
+import lark
 import pytest
 from mamushi import compare_ast
+from mamushi.formatting.format import format_tree
+from mamushi.parsing.comparator import find_ast_change
+from mamushi.parsing import generate_tables, registry
+from mamushi.parsing.indenter import PythonIndenter
+from mamushi.parsing.parser import Parser
+from mamushi.parsing.pytree import Leaf, Node
+
+from tests.const import MINIMAL_CONTRACT
 
 
 def test_comparator():
@@ -29,3 +45,200 @@ def b():
     assert compare_ast(test_input, test_input)
     assert compare_ast(test_input, should_parse_similarly)
     assert not compare_ast(test_input, should_not_parse_similarly)
+
+
+def in_function(body: str) -> str:
+    return "@external\ndef f():\n" + textwrap.indent(body, "    ") + "\n"
+
+
+@pytest.mark.parametrize(
+    "original,formatted",
+    [
+        ("x: uint256 = (a + 2) * 3", "x: uint256 = ((a + 2)) * 3"),
+        ("assert a > 1", "assert (a > 1)"),
+        ("f(a, b)", "f(\n    a,\n    b,\n)"),
+        ("x = 'a'", 'x = "a"'),
+    ],
+)
+def test_comparator_ignores_formatting(original, formatted):
+    assert compare_ast(in_function(original), in_function(formatted))
+
+
+@pytest.mark.parametrize(
+    "original,changed",
+    [
+        ("x: uint256 = (a + 2) * 3", "x: uint256 = a + 2 * 3"),
+        ("x: bool = not a", "x: bool = a"),
+        ("x = a - b", "x = a + b"),
+        ("if a:\n    b()\n    c()", "if a:\n    b()\nc()"),
+    ],
+)
+def test_comparator_detects_changes(original, changed):
+    assert not compare_ast(in_function(original), in_function(changed))
+
+
+def test_find_ast_change():
+    original = in_function("x: uint256 = 1\ny: uint256 = a - b")
+    change = find_ast_change(original, original.replace("-", "+"))
+    assert change is not None
+    assert change.line == 4
+    assert change.rule == "declaration"
+    assert "expected `sub`" in str(change)
+    assert find_ast_change(original, original) is None
+
+
+def test_find_ast_change_truncated():
+    original = in_function("x: uint256 = 1\ny: uint256 = 2")
+    change = find_ast_change(original, in_function("x: uint256 = 1"))
+    assert change is not None
+    assert change.rule == "function_def"
+
+
+def test_comparator_reuses_source_fingerprint():
+    parser = Parser()
+    parser.parse(MINIMAL_CONTRACT, fingerprint=True)
+    assert parser.last_fingerprint is not None
+    assert compare_ast(
+        "", MINIMAL_CONTRACT, src_fingerprint=parser.last_fingerprint
+    )
+    parser.parse(MINIMAL_CONTRACT)
+    assert parser.last_fingerprint is None
+
+
+def test_find_ast_change_from_source_fingerprint():
+    original = in_function("x: uint256 = 1\ny: uint256 = a - b")
+    parser = Parser()
+    parser.parse(original, fingerprint=True)
+    change = find_ast_change(
+        original,
+        original.replace("-", "+"),
+        src_fingerprint=parser.last_fingerprint,
+    )
+    assert change is not None
+    assert change.line == 4
+    assert "expected `sub`" in str(change)
+
+
+def _parse_and_count(_):
+    Parser().parse(MINIMAL_CONTRACT)
+    compare_ast(MINIMAL_CONTRACT, MINIMAL_CONTRACT)
+    return os.getpid(), registry.compilation_count()
+
+
+def test_grammars_compiled_once():
+    _, compiled = _parse_and_count(None)
+    for _ in range(3):
+        assert _parse_and_count(None)[1] == compiled
+    assert registry.compilation_count(registry.FORMATTING) >= 1
+
+
+def test_grammars_compiled_once_per_worker():
+    with multiprocessing.Pool(2) as pool:
+        counts = pool.map(_parse_and_count, range(8))
+    per_worker = defaultdict(set)
+    for pid, compiled in counts:
+        per_worker[pid].add(compiled)
+    assert all(len(compiled) == 1 for compiled in per_worker.values())
+
+
+TABLES = registry.read_tables()
+
+same_lark_version = pytest.mark.skipif(
+    TABLES is None
+    or TABLES["lark_version"].split(".")[:2]
+    != lark.__version__.split(".")[:2],
+    reason="parse tables were generated by another version of lark",
+)
+
+
+def test_lalr_tables_in_sync_with_grammar():
+    assert TABLES is not None
+    assert TABLES["grammar_sha256"] == registry.grammar_sha256(), (
+        "grammar.lark changed, regenerate the parse tables with "
+        "`python -m mamushi.parsing.generate_tables`"
+    )
+
+
+@same_lark_version
+def test_lalr_tables_match_compiled_grammar():
+    assert TABLES is not None
+    for name, options in registry.GRAMMAR_OPTIONS.items():
+        data, memo = generate_tables.serialize_tables(
+            generate_tables.compile_grammar(options)
+        )
+        # through JSON, which turns tuples into lists
+        compiled = json.loads(
+            generate_tables.dumps({"data": data, "memo": memo}),
+            object_pairs_hook=registry._int_keys,
+        )
+        assert TABLES["tables"][name] == compiled
+
+
+@same_lark_version
+@pytest.mark.parametrize("name", list(registry.GRAMMAR_OPTIONS))
+def test_lalr_tables_load(name):
+    options = registry.GRAMMAR_OPTIONS[name]
+    loaded = registry._load_tables(name, postlex=PythonIndenter())
+    assert loaded is not None
+    assert loaded.options.keep_all_tokens == options["keep_all_tokens"]
+
+
+def test_orphaned_comments_attach_to_line_above(parser):
+    block = "".join(f"        # comment {i}\n" for i in range(50))
+    source = (
+        "@external\n"
+        "def a():\n"
+        "    x: uint256 = self.b(\n"
+        f"{block}"
+        "        1,\n"
+        "    )\n"
+    )
+    # the same call without the comments must keep its own newlines
+    source += source.replace("def a", "def c").replace(block, "")
+    formatted = format_tree(parser.parse(source))
+    assert formatted.count("# comment") == 50
+    assert formatted.index("# comment 0") < formatted.index("# comment 49")
+    assert formatted.index("# comment 49") < formatted.index("        1,")
+
+
+def test_parse_deeply_nested_code(parser):
+    depth = 2 * sys.getrecursionlimit()
+    source = (
+        "@external\n"
+        "def a():\n"
+        f"    x: uint256 = {'(' * depth}1{')' * depth}\n"
+    )
+    tree = parser.parse(source)
+    leaf = tree
+    while not isinstance(leaf, Leaf):
+        leaf = leaf.children[0]
+    assert leaf.value == "@"
+
+
+def test_parser_builds_pytree(parser):
+    source = MINIMAL_CONTRACT + "# last\n"
+    tree = parser.parse(source)
+    assert isinstance(tree, Node)
+    assert tree.type == "module"
+    # comments are spliced in the tree along with the parsed leaves
+    stack = [tree]
+    leaves = []
+    while stack:
+        node = stack.pop()
+        for child in node.children:
+            assert child.parent is node
+            if isinstance(child, Leaf):
+                leaves.append(child)
+            else:
+                stack.append(child)
+    assert any(leaf.value.strip() == "# last" for leaf in leaves)
+
+
+def test_parser_reused_after_error(parser):
+    expected = format_tree(Parser().parse(MINIMAL_CONTRACT))
+    with pytest.raises(lark.exceptions.LarkError):
+        parser.parse("@external\ndef a(:\n    if (\n        pass\n")
+    assert format_tree(parser.parse(MINIMAL_CONTRACT)) == expected
+    # nothing collected while parsing outlives the parse
+    assert not parser.indenter.processed_newlines
+    assert not parser._comments and not parser._terminals
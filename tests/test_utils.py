@@ -1,5 +1,19 @@
+import os
+import re
+
 import pytest
 from mamushi import gen_vyper_files_in_dir
+from mamushi.utils.files import write_atomically
+from mamushi.utils import workers
+from mamushi.utils.workers import (
+    BATCH_BYTES,
+    BYTES_PER_WORKER,
+    SMALL_FILE_BYTES,
+    available_cpus,
+    cgroup_cpu_limit,
+    choose_workers,
+    schedule,
+)
 
 
 def test_gen_python_files_in_dir(tmp_path):
@@ -14,3 +28,148 @@ def test_gen_python_files_in_dir(tmp_path):
                 valid_files.append(fake_file)
     found_files = gen_vyper_files_in_dir(tmp_path)
     assert set(valid_files) == set(found_files)
+
+
+def make_tree(root, paths):
+    for path in paths:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text("")
+
+
+def relative_files(root, **kwargs):
+    return [
+        path.relative_to(root).as_posix()
+        for path in gen_vyper_files_in_dir(root, **kwargs)
+    ]
+
+
+TREE = [
+    "a.vy",
+    "b.vyi",
+    "c.py",
+    "lib/x/d.vy",
+    "lib/e.vy",
+    "node_modules/f.vy",
+    "src/g.vy",
+    "src/tests/h.vy",
+]
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_exclude(tmp_path, threads):
+    make_tree(tmp_path, TREE)
+    assert relative_files(
+        tmp_path,
+        extend_exclude=re.compile("/(node_modules|tests)/|/e\\.vy$"),
+        threads=threads,
+    ) == ["a.vy", "b.vyi", "lib/x/d.vy", "src/g.vy"]
+    # the directory walked isn't matched itself
+    assert relative_files(
+        tmp_path / "lib", exclude=re.compile("^/lib/"), threads=threads
+    ) == ["e.vy", "x/d.vy"]
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_gitignore(tmp_path, threads):
+    (tmp_path / ".git").mkdir()
+    make_tree(tmp_path, TREE)
+    (tmp_path / ".gitignore").write_text("/lib/x\nnode_modules/\n")
+    (tmp_path / "src" / ".gitignore").write_text("h.vy\n")
+    assert relative_files(tmp_path, threads=threads) == [
+        "a.vy",
+        "b.vyi",
+        "lib/e.vy",
+        "src/g.vy",
+    ]
+    # those of the parents of the directory apply too
+    assert relative_files(tmp_path / "lib", threads=threads) == ["e.vy"]
+    assert relative_files(tmp_path / "src" / "tests") == []
+    assert len(relative_files(tmp_path, gitignore=False)) == 7
+
+
+def test_symlinks_followed_once(tmp_path):
+    make_tree(tmp_path, ["src/a.vy", "src/b.vy", "other/c.vy"])
+    (tmp_path / "src" / "c.vy").symlink_to(tmp_path / "other" / "c.vy")
+    (tmp_path / "zlink").symlink_to(tmp_path / "src")
+    # a cycle
+    (tmp_path / "src" / "loop").symlink_to(tmp_path)
+    (tmp_path / "missing.vy").symlink_to(tmp_path / "nowhere.vy")
+    assert relative_files(tmp_path) == [
+        "other/c.vy",
+        "src/a.vy",
+        "src/b.vy",
+    ]
+
+
+def test_write_atomically(tmp_path):
+    target = tmp_path / "a.vy"
+    target.write_text("old")
+    target.chmod(0o754)
+    link = tmp_path / "link.vy"
+    link.symlink_to(target)
+    write_atomically(link, "new\n")
+    assert link.is_symlink()
+    assert target.read_text() == "new\n"
+    assert target.stat().st_mode & 0o777 == 0o754
+    write_atomically(target, b"newer\n")
+    assert target.read_bytes() == b"newer\n"
+    # no temporary file is left behind
+    assert sorted(os.listdir(tmp_path)) == ["a.vy", "link.vy"]
+
+
+@pytest.mark.parametrize(
+    "files,limit",
+    [
+        ({"cpu.max": "max 100000\n"}, None),
+        ({"cpu.max": "250000 100000\n"}, 2.5),
+        ({"cpu/cpu.cfs_quota_us": "-1\n", "cpu/cpu.cfs_period_us": "1"}, None),
+        (
+            {
+                "cpu/cpu.cfs_quota_us": "100000\n",
+                "cpu/cpu.cfs_period_us": "50000\n",
+            },
+            2,
+        ),
+        ({}, None),
+    ],
+)
+def test_cgroup_cpu_limit(tmp_path, files, limit):
+    for name, content in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(content)
+    assert cgroup_cpu_limit(tmp_path) == limit
+
+
+def test_available_cpus(monkeypatch):
+    monkeypatch.setattr(workers, "cgroup_cpu_limit", lambda: 0.5)
+    assert available_cpus() == 1
+    monkeypatch.setattr(workers, "cgroup_cpu_limit", lambda: None)
+    assert available_cpus() >= 1
+
+
+def test_choose_workers(monkeypatch):
+    monkeypatch.setattr(workers, "available_cpus", lambda: 4)
+    assert choose_workers([], 3) == 3
+    assert choose_workers([10**6] * 8, 0) == 0
+    # single files and small batches are formatted in-process
+    assert choose_workers([10**6]) == 0
+    assert choose_workers([1000] * 50) == 0
+    assert choose_workers([BYTES_PER_WORKER] * 3) == 3
+    assert choose_workers([10**6] * 8) == 4
+
+
+def test_schedule():
+    small = SMALL_FILE_BYTES - 1
+    sizes = [small, 10**5, 10, SMALL_FILE_BYTES, 10**6, small] + [
+        small
+    ] * 8
+    tasks = schedule(sizes)
+    assert sorted(i for task in tasks for i in task) == list(range(14))
+    # large files first, one per task, largest first
+    assert tasks[:3] == [[4], [1], [3]]
+    # then small files, batched
+    assert all(len(task) > 1 for task in tasks[3:-1])
+    assert all(
+        sum(sizes[i] for i in task) - small < BATCH_BYTES for task in tasks[3:]
+    )